@@ -2,10 +2,12 @@
 from __future__ import print_function
 from collections import Counter
 from datetime import datetime
-import json
 import os
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_processing'))
+from snooper_records import read_records
+
 TIME_FMT = '%m-%d-%Y %H:%M:%S.%f'
 REPORT_DEPTH = 4
 
@@ -47,8 +49,7 @@ class PyModuleCounter(Counter):
             else:
                 self._prefixes[path] = 'P{}'.format(len(self._prefixes))
 
-    def _parse_line(self, line):
-        d = json.loads(line)
+    def _parse_record(self, d):
         timestamp = datetime.strptime(d['timestamp'], TIME_FMT)
         python_exe = d['sys.executable']
         sys_paths = d['sys.path']
@@ -63,17 +64,16 @@ class PyModuleCounter(Counter):
         }
         return counted_path_set
         
-    def countline(self, line):
-        '''Increment internal count from modules in line'''
-        modulePaths = self._parse_line(line)
+    def countrecord(self, record):
+        '''Increment internal count from modules in record'''
+        modulePaths = self._parse_record(record)
         self += Counter(modulePaths)
 
 
 def main(*log_files):
     counter = PyModuleCounter()
     for fname in set(log_files):
-        with open(fname) as fp:
-            for line in fp: counter.countline(line)
+        for record in read_records(fname): counter.countrecord(record)
 
     print("Prefixes:")
     print(*counter.used_prefixes(), sep='\n')
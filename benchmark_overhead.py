@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+'''Measure the per-process overhead of the sitecustomize.py hook.
+
+Each case runs in fresh interpreters that load sitecustomize.py, populate
+sys.modules with synthetic modules (spread over synthetic installed
+distributions) and os.environ with synthetic variables, then call
+inspect_and_log() with LOGFILE_ROOT on tmpfs. Per case it reports the median
+of --repeat runs of
+
+    startup_ms          time to import the hook
+    shutdown_ms         time spent in inspect_and_log()
+    bytes               bytes written to the log tree (records and blobs)
+    python_ms           wall time of `python -c pass` without the hook
+    python_hook_ms      the same with the hook on PYTHONPATH, from interpreter
+                        start to exit (its record spooled to tmpfs)
+    python_overhead_ms  the difference
+
+Results are written as JSON; with --check they are compared against the
+limits in benchmark_thresholds.json and the exit status is 1 if any is
+exceeded.
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HOOK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sitecustomize.py')
+THRESHOLDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_thresholds.json')
+MODULE_COUNTS = (10, 1000, 10000)
+ENV_COUNTS = (50, 500)
+METRICS = ('startup_ms', 'shutdown_ms', 'bytes', 'python_ms', 'python_hook_ms', 'python_overhead_ms')
+# metrics reported as the lower median, a value of the runs, so they stay integers
+INTEGER_METRICS = ('bytes',)
+# synthetic modules per synthetic distribution
+MODULES_PER_PACKAGE = 100
+
+# run in the child interpreter: argv = hook path, log root, site dir, module count
+CHILD = r'''
+import importlib.util, json, os, sys, time, types
+hook_path, log_root, site_dir, n_modules = sys.argv[1], sys.argv[2], sys.argv[3], int(sys.argv[4])
+
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location('sitecustomize', hook_path)
+hook = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(hook)
+startup = time.perf_counter() - start
+
+hook.LOGFILE_ROOT = log_root
+sys.path.append(site_dir)
+for i in range(n_modules):
+    package = 'bench_pkg_{}'.format(i // %(per_package)d)
+    name = '{}.mod_{}'.format(package, i)
+    module = types.ModuleType(name)
+    module.__file__ = os.path.join(site_dir, package, 'mod_{}.py'.format(i))
+    sys.modules[name] = module
+
+start = time.perf_counter()
+hook.inspect_and_log()
+shutdown = time.perf_counter() - start
+print(json.dumps({'startup': startup, 'shutdown': shutdown}))
+''' % {'per_package': MODULES_PER_PACKAGE}
+
+
+def make_site_dir(root, n_modules):
+    '''A site-packages directory with one installed distribution per synthetic package'''
+    site_dir = os.path.join(root, 'site-packages')
+    for k in range((n_modules + MODULES_PER_PACKAGE - 1) // MODULES_PER_PACKAGE):
+        package = 'bench_pkg_{}'.format(k)
+        dist_info = os.path.join(site_dir, '{}-1.{}.dist-info'.format(package, k))
+        os.makedirs(dist_info)
+        with open(os.path.join(dist_info, 'METADATA'), 'w') as f:
+            f.write('Metadata-Version: 2.1\nName: {}\nVersion: 1.{}\n'.format(package, k))
+        with open(os.path.join(dist_info, 'top_level.txt'), 'w') as f:
+            f.write(package + '\n')
+    return site_dir
+
+
+def make_env(root, n_env):
+    '''An environment of n_env variables shaped like a batch job's, all of them
+    kept by the hook: the shipped sitecustomize_env.json would drop the
+    synthetic ones, leaving the env dimension nothing to measure'''
+    env_filter = os.path.join(root, 'env_filter.json')
+    with open(env_filter, 'w') as f:
+        json.dump({'allow': [], 'deny': []}, f)
+    env = {
+        'PATH': os.environ.get('PATH', '/usr/bin:/bin'),
+        'HOME': root,
+        'USER': 'bench',
+        'PBS_JOBID': '123456.bench',
+        'PYMODULE_LOG_CACHE': os.path.join(root, 'cache'),
+        'PYMODULE_LOG_SOCKET': os.path.join(root, 'absent.sock'),
+        'PYMODULE_LOG_ON_SIRIUS': '0',
+        'PYMODULE_LOG_ENV_FILTER': env_filter,
+    }
+    for i in range(n_env - len(env)):
+        env['BENCH_VAR_{}'.format(i)] = '/opt/bench/{}/'.format(i) * 8
+    return env
+
+
+def time_python(env):
+    '''Wall time in seconds of a `python -c pass` run with env'''
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'], env=env, check=True)
+    return time.perf_counter() - start
+
+
+def directory_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(dirpath, name)) for name in filenames)
+    return total
+
+
+def run_case(root, n_modules, n_env, repeat):
+    case_root = os.path.join(root, '{}x{}'.format(n_modules, n_env))
+    site_dir = make_site_dir(case_root, n_modules)
+    env = make_env(case_root, n_env)
+    runs = []
+    for i in range(repeat):
+        log_root = os.path.join(case_root, 'logs', str(i))
+        # every run writes a full record: forget fingerprints of earlier runs,
+        # but keep the distribution index cache as a long-lived node would
+        fingerprints = os.path.join(env['PYMODULE_LOG_CACHE'], 'fingerprints.json')
+        if os.path.exists(fingerprints):
+            os.unlink(fingerprints)
+        output = subprocess.run(
+            [sys.executable, '-c', CHILD, HOOK_PATH, log_root, site_dir, str(n_modules)],
+            env=env, check=True, stdout=subprocess.PIPE, universal_newlines=True,
+        ).stdout
+        timings = json.loads(output.splitlines()[-1])
+        python = time_python(env)
+        hook_env = dict(env, PYTHONPATH=os.path.dirname(HOOK_PATH),
+                        PYMODULE_LOG_SPOOL=os.path.join(case_root, 'spool', str(i)))
+        python_hook = time_python(hook_env)
+        runs.append({
+            'startup_ms': timings['startup'] * 1e3,
+            'shutdown_ms': timings['shutdown'] * 1e3,
+            'bytes': directory_size(log_root),
+            'python_ms': python * 1e3,
+            'python_hook_ms': python_hook * 1e3,
+            'python_overhead_ms': (python_hook - python) * 1e3,
+        })
+    result = {'modules': n_modules, 'env': n_env}
+    for metric in METRICS:
+        median = statistics.median_low if metric in INTEGER_METRICS else statistics.median
+        result[metric] = median(run[metric] for run in runs)
+    return result
+
+
+def check_thresholds(results, thresholds):
+    '''Messages for every metric above its limit'''
+    failures = []
+    for result in results['cases']:
+        name = '{}x{}'.format(result['modules'], result['env'])
+        for metric, limit in thresholds.get(name, {}).items():
+            if result[metric] > limit:
+                failures.append('{} {}: {:.1f} > {}'.format(name, metric, result[metric], limit))
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the per-process overhead of sitecustomize.py.")
+    parser.add_argument('-o', '--output', default='benchmark_results.json',
+                        help="Results file. [DEFAULT=benchmark_results.json]")
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help="Interpreters run per case. [DEFAULT=5]")
+    parser.add_argument('-d', '--tmpdir', default='/dev/shm' if os.path.isdir('/dev/shm') else None,
+                        help="Directory (tmpfs) for the log tree and synthetic packages. [DEFAULT=/dev/shm]")
+    parser.add_argument('-t', '--thresholds', default=THRESHOLDS_PATH,
+                        help="Regression thresholds. [DEFAULT=benchmark_thresholds.json]")
+    parser.add_argument('--check', action='store_true',
+                        help="Exit with status 1 if a result exceeds its threshold.")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='pymodulesnooper-bench-', dir=args.tmpdir)
+    try:
+        cases = []
+        for n_modules in MODULE_COUNTS:
+            for n_env in ENV_COUNTS:
+                result = run_case(root, n_modules, n_env, args.repeat)
+                print('{modules:6d} modules {env:4d} env: startup {startup_ms:7.2f} ms '
+                      'shutdown {shutdown_ms:8.2f} ms {bytes:9d} bytes '
+                      'python -c pass {python_ms:7.2f} ms, with the hook {python_hook_ms:7.2f} ms'.format(**result))
+                cases.append(result)
+    finally:
+        shutil.rmtree(root)
+
+    results = {'python': platform.python_version(), 'repeat': args.repeat, 'cases': cases}
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.check:
+        with open(args.thresholds) as f:
+            failures = check_thresholds(results, json.load(f))
+        for failure in failures:
+            print('over threshold:', failure)
+        sys.exit(1 if failures else 0)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+'''Per-node PyModuleSnooper collector daemon.
+
+sitecustomize.py hands its record to this daemon with a single non-blocking
+sendto() on a Unix datagram socket (PYMODULE_LOG_SOCKET) and falls back to
+writing its own log file when the socket is absent or the send fails. The
+daemon takes file creation and shared filesystem latency off the user's
+shutdown path: it buffers records in memory, drops duplicate datagrams, moves
+env/sys.path to the day's blob store and appends each batch to one file per
+node per day, LOGROOT/YYYY/MM/DD/<hostname>.collector.
+
+If the shared filesystem is slow or failing, records keep being received and
+buffered (up to --max-buffered, oldest dropped first) until a write succeeds.
+'''
+import argparse
+import collections
+from datetime import datetime
+import hashlib
+import os
+import signal
+import socket
+import sys
+import threading
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_processing'))
+from snooper_records import BLOB_DIRNAME, decode_binary_records, dedup_blobs, encode_binary_record
+
+DATETIME_FMT = '%m-%d-%Y %H:%M:%S.%f'
+DEFAULT_SOCKET = os.path.join('/run', 'pymodulesnooper', 'collector.sock')
+# larger records fail in sendto() and are written directly by the client
+MAX_DATAGRAM = 4 * 1024 * 1024
+
+
+class Collector:
+    def __init__(self, socket_path, log_root, max_buffered):
+        self.socket_path = socket_path
+        self.log_root = log_root
+        self.fname = '{}.collector'.format(socket.gethostname())
+        self.dropped = 0
+        self.rejected = 0
+        self.received = 0
+        self.written = 0
+        self._pending = collections.deque()
+        self._max_buffered = max_buffered
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sock = None
+
+    def bind(self):
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self.socket_path)
+        # every user's interpreter sends to the same socket
+        os.chmod(self.socket_path, 0o666)
+        # wake up regularly to notice stop()
+        sock.settimeout(1.0)
+        self._sock = sock
+
+    def stop(self, *args):
+        self._stop.set()
+
+    def receive(self):
+        while not self._stop.is_set():
+            try:
+                data = self._sock.recv(MAX_DATAGRAM)
+            except socket.timeout:
+                continue
+            with self._lock:
+                self.received += 1
+                if len(self._pending) >= self._max_buffered:
+                    self._pending.popleft()
+                    self.dropped += 1
+                self._pending.append(data)
+
+    def log_path(self, record):
+        date = datetime.strptime(record['timestamp'], DATETIME_FMT)
+        day_dir = os.path.join(self.log_root, date.strftime(os.path.join('%Y', '%m', '%d')))
+        return os.path.join(day_dir, self.fname)
+
+    def flush(self):
+        with self._lock:
+            batch = list(self._pending)
+            self._pending.clear()
+
+        # group by destination file, dropping repeated datagrams
+        seen = set()
+        by_path = collections.OrderedDict()
+        for data in batch:
+            digest = hashlib.sha1(data).digest()
+            if digest in seen:
+                continue
+            seen.add(digest)
+            try:
+                records = [(self.log_path(record), record) for record in decode_binary_records(data)]
+            except (ValueError, zlib.error, KeyError, TypeError):
+                # a corrupt datagram or a record without a timestamp: drop it, keep the batch
+                self.rejected += 1
+                continue
+            for path, record in records:
+                by_path.setdefault(path, []).append((data, record))
+
+        for path, items in by_path.items():
+            try:
+                blob_dir = os.path.join(os.path.dirname(path), BLOB_DIRNAME)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                chunk = b''.join(
+                    encode_binary_record(dedup_blobs(record, blob_dir)) for _, record in items
+                )
+                with open(path, 'ab') as f:
+                    f.write(chunk)
+                self.written += len(items)
+            except OSError as e:
+                print('failed to write {}: {}; keeping {} records'.format(path, e, len(items)))
+                with self._lock:
+                    self._pending.extendleft(reversed(list(dict.fromkeys(data for data, _ in items))))
+
+    def run(self, flush_interval):
+        receiver = threading.Thread(target=self.receive, daemon=True)
+        receiver.start()
+        try:
+            while not self._stop.wait(flush_interval):
+                self.flush()
+        finally:
+            self._stop.set()
+            receiver.join()
+            self._sock.close()
+            os.unlink(self.socket_path)
+            self.flush()
+            print('received {} written {} dropped {} rejected {}'.format(
+                self.received, self.written, self.dropped, self.rejected))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect PyModuleSnooper records sent over a Unix socket.")
+    parser.add_argument('log_root', help="Shared log directory (LOGFILE_ROOT in sitecustomize.py)")
+    parser.add_argument('-s', '--socket', default=DEFAULT_SOCKET,
+                        help="Socket path (PYMODULE_LOG_SOCKET). [DEFAULT=%s]" % DEFAULT_SOCKET)
+    parser.add_argument('-i', '--flush-interval', type=float, default=10.0,
+                        help="Seconds between writes to the shared filesystem. [DEFAULT=10]")
+    parser.add_argument('-b', '--max-buffered', type=int, default=100000,
+                        help="Records kept in memory while writes are failing. [DEFAULT=100000]")
+    args = parser.parse_args()
+
+    collector = Collector(args.socket, args.log_root, args.max_buffered)
+    collector.bind()
+    signal.signal(signal.SIGTERM, collector.stop)
+    signal.signal(signal.SIGINT, collector.stop)
+    collector.run(args.flush_interval)
@@ -1,15 +1,18 @@
 import argparse
 from datetime import datetime, timedelta
+import os
 from pathlib import Path
 
 parser = argparse.ArgumentParser(
-    description="Create log folders (YYYY/MM/DD) for N days into the future."
+    description="Create log folders (YYYY/MM/DD) for N days into the future, and the "
+    "day's hXX shard folders if PYMODULE_LOG_SHARDS is set as for sitecustomize.py."
 )
 parser.add_argument(
     'num_days', type=int, help="Create folders for this many days"
 )
 
 num_days = parser.parse_args().num_days
+shards = int(os.environ.get('PYMODULE_LOG_SHARDS', 0) or 0)
 dates = [datetime.now() + timedelta(days=i) for i in range(num_days)]
 
 def fmt(n):
@@ -22,3 +25,12 @@ for date in dates:
     p.parent.parent.chmod(0o2755)
     p.parent.chmod(0o2755)
     p.chmod(0o3777)
+    # content-addressed store for env/sys.path blobs shared by the day's records
+    blobs = p.joinpath('.blobs')
+    blobs.mkdir(exist_ok=True)
+    blobs.chmod(0o3777)
+    # sitecustomize.py only creates a missing day or shard, never a year or month
+    for shard in range(shards):
+        shard_dir = p.joinpath(f'h{shard:02x}')
+        shard_dir.mkdir(exist_ok=True)
+        shard_dir.chmod(0o3777)
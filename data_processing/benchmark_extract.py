@@ -0,0 +1,46 @@
+import argparse
+import json
+import os
+import timeit
+from snooper_records import compile_fields, extract_fields, select_fields
+
+DEFAULT_RECORD = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example_log_output.json')
+# the field specs of the ingestion scripts; process_logfiles.py reads most of
+# the record and a selection of env keys, which measured slower than json.loads
+FIELD_SPECS = {
+   'parse_snooper_data': {'sys.executable': None, 'modules': None},
+}
+
+
+def time_per_call(func, number):
+   '''Best of 5 runs, in milliseconds per call'''
+   return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e3
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="""
+Compare a full json.loads of a log record with extract_fields for the field specs
+of the ingestion scripts, checking both give the same fields.
+""")
+   parser.add_argument("-r", "--record", help="JSON record to decode. [DEFAULT=example_log_output.json]", default=DEFAULT_RECORD)
+   parser.add_argument("-n", "--number", type=int, help="Decodes per timing run.", default=200)
+   parser.add_argument("-e", "--env-kb", type=int, help="Pad env with module-path-like variables to this many KB.", default=0)
+   args = parser.parse_args()
+
+   with open(args.record) as f:
+      record = json.load(f)
+   padding = 0
+   while len(json.dumps(record['env'])) < args.env_kb * 1024:
+      record['env'][f'BENCH_MODULEPATH_{padding}'] = f'/opt/cray/pe/lmod/modulefiles/mpi/{padding}:/soft/modulefiles' * 4
+      padding += 1
+   # one line, as sitecustomize.py writes it
+   text = json.dumps(record)
+
+   full_ms = time_per_call(lambda: json.loads(text), args.number)
+   print(f"record: {len(text)} bytes")
+   print(f"{'json.loads':>20}: {full_ms:8.3f} ms")
+   for name, fields in FIELD_SPECS.items():
+      select = compile_fields(fields)
+      assert extract_fields(text, select) == select_fields(json.loads(text), select), name
+      ms = time_per_call(lambda: extract_fields(text, select), args.number)
+      print(f"{name:>20}: {ms:8.3f} ms  ({full_ms / ms:.1f}x)")
@@ -1,11 +1,12 @@
 import pandas as pd
 import argparse
 import glob
+from frame_io import read_frame, write_frame
 
 if __name__ == "__main__":
    parser = argparse.ArgumentParser(description="Combine multiple compressed CSV files into one.")
-   parser.add_argument("-g","--input_glob", help="Glob string to select input compressed CSV files.")
-   parser.add_argument("-o","--output_file", help="Name of the output combined compressed CSV file.")
+   parser.add_argument("-g","--input_glob", help="Glob string to select input compressed CSV files, Parquet files or datasets.")
+   parser.add_argument("-o","--output_file", help="Name of the output combined compressed CSV file, or Parquet file if it ends in .parquet.")
    args = parser.parse_args()
 
    # Collect CSV files
@@ -14,11 +15,11 @@ if __name__ == "__main__":
 
    dfs = []
    for idx, file in enumerate(all_files, 1):
-      dfs.append(pd.read_csv(file, compression='gzip'))
+      dfs.append(read_frame(file))
       print(f"Processed file {idx}/{len(all_files)}: {file}")
 
    combined_df = pd.concat(dfs, ignore_index=True)
 
    # Save to compressed CSV
-   combined_df.to_csv(args.output_file, index=False, compression='gzip')
-   print(f"Combined CSV saved to {args.output_file}.")
+   write_frame(combined_df, args.output_file)
+   print(f"Combined data saved to {args.output_file}.")
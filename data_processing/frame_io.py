@@ -0,0 +1,267 @@
+'''Reading and writing the datasets of the processing scripts as gzip CSV or Parquet.
+
+CSV output is one gzip CSV file per day (or per run), as it always was. With
+--format parquet the output is instead a directory of Parquet files
+partitioned by day:
+
+    <root>/year=YYYY/month=MM/day=DD/part-<id>.parquet
+
+Appending rows adds a part file to the day's directory. In Parquet files,
+string columns are dictionary encoded, the list columns a writer names (such as
+'Categories') are stored as lists, and timestamps as timestamps, so readers
+neither parse the timestamps again nor eval the lists. Reading can project the
+columns it needs.
+
+Parquet needs pyarrow, which is optional: the CSV format works without it.
+'''
+import ast
+import glob
+import os
+import shutil
+import uuid
+import pandas as pd
+
+try:
+   import pyarrow
+   import pyarrow.dataset as pads
+   import pyarrow.parquet as pq
+except ImportError:
+   pyarrow = None
+
+FORMAT_CSV = 'csv'
+FORMAT_PARQUET = 'parquet'
+FORMATS = (FORMAT_CSV, FORMAT_PARQUET)
+PARTITION_KEYS = ('year', 'month', 'day')
+PART_SUFFIX = '.parquet'
+# the format of the timestamps sitecustomize.py writes
+TIMESTAMP_FORMAT = '%m-%d-%Y %H:%M:%S.%f'
+
+
+def _string_type():
+   return pyarrow.dictionary(pyarrow.int32(), pyarrow.string()) if pyarrow is not None else None
+
+
+# the Arrow type of every string column written
+STRING_TYPE = _string_type()
+
+
+def check_format(output_format):
+   '''Raise ImportError if output_format cannot be written here'''
+   if output_format == FORMAT_PARQUET and pyarrow is None:
+      raise ImportError('the parquet format needs pyarrow: pip install pyarrow')
+
+
+def is_parquet(path):
+   '''True for Parquet files and dataset directories'''
+   return path.endswith(PART_SUFFIX) or os.path.isdir(path)
+
+
+def partition_dir(root, year, month, day):
+   return os.path.join(root, f'year={int(year):04d}', f'month={int(month):02d}', f'day={int(day):02d}')
+
+
+def split_partition_dir(path):
+   '''(dataset root, (year, month, day)) of a day directory of a dataset, or None'''
+   parts = os.path.normpath(path).split(os.sep)
+   if len(parts) < 4:
+      return None
+   values = []
+   for key, part in zip(PARTITION_KEYS, parts[-3:]):
+      name, _, value = part.partition('=')
+      if name != key or not value.isdigit():
+         return None
+      values.append(int(value))
+   return os.sep.join(parts[:-3]), tuple(values)
+
+
+def is_dataset(path):
+   '''True for the root directory of a partitioned Parquet dataset'''
+   return bool(glob.glob(os.path.join(path, PARTITION_KEYS[0] + '=*')))
+
+
+def partition_filters(years=(), months=(), days=()):
+   '''read_frame filters selecting the given years, months and days (all if empty)'''
+   filters = [(key, 'in', list(values)) for key, values in zip(PARTITION_KEYS, (years, months, days)) if values]
+   return filters or None
+
+
+def partition_exists(directory):
+   return bool(glob.glob(os.path.join(directory, '*' + PART_SUFFIX)))
+
+
+def _arrow_ready(df, list_columns=()):
+   '''df with object columns given one type each, as Parquet needs.
+
+   The list_columns stay lists. Other object columns become numbers if all
+   their values are numbers (as read_csv would read them back), else strings,
+   lists included, so a column has the same type in every part file;
+   categorical columns of other than strings are treated the same. A
+   'Timestamp' column of sitecustomize.py timestamps becomes datetimes.
+   '''
+   df = df.copy()
+   if 'Timestamp' in df.columns and not pd.api.types.is_datetime64_any_dtype(df['Timestamp']):
+      timestamps = pd.to_datetime(df['Timestamp'].astype(object), format=TIMESTAMP_FORMAT, errors='coerce')
+      if timestamps.notna().sum() == df['Timestamp'].notna().sum():
+         df['Timestamp'] = timestamps
+   for name in df.columns:
+      column = df[name]
+      if name in list_columns:
+         continue
+      if isinstance(column.dtype, pd.CategoricalDtype):
+         if column.cat.categories.dtype == object and all(isinstance(value, str) for value in column.cat.categories):
+            continue
+         column = column.astype(object)
+      elif column.dtype != object:
+         continue
+      values = column.dropna()
+      if len(values) == 0:
+         continue
+      numbers = pd.to_numeric(values, errors='coerce')
+      if numbers.notna().all():
+         df[name] = pd.to_numeric(column)
+      else:
+         df[name] = column.map(str, na_action='ignore')
+   return df
+
+
+def _is_string_type(arrow_type):
+   if pyarrow.types.is_dictionary(arrow_type):
+      arrow_type = arrow_type.value_type
+   return pyarrow.types.is_string(arrow_type) or pyarrow.types.is_large_string(arrow_type)
+
+
+def _write_parquet(df, path, list_columns=()):
+   table = pyarrow.Table.from_pandas(_arrow_ready(df, list_columns), preserve_index=False)
+   # categorical and object string columns alike, whatever the size of the
+   # categories, so every part file of a dataset has the same schema
+   schema = pyarrow.schema([
+      field.with_type(STRING_TYPE) if _is_string_type(field.type) else field
+      for field in table.schema
+   ])
+   pq.write_table(table.cast(schema), path, use_dictionary=True, compression='zstd')
+
+
+def write_part(df, directory, list_columns=()):
+   '''Write df as a new part file in directory, with list_columns stored as
+   lists; returns its path, or None for an empty df, as a file without columns
+   would hide the dataset's schema'''
+   if len(df) == 0:
+      return None
+   os.makedirs(directory, exist_ok=True)
+   path = os.path.join(directory, f'part-{uuid.uuid4().hex}{PART_SUFFIX}')
+   _write_parquet(df, path, list_columns)
+   return path
+
+
+def write_partition(df, root, year, month, day, append=False, list_columns=()):
+   '''Write df as the rows of one day of the Parquet dataset at root; appended
+   as a new part file, or replacing the day's existing files'''
+   directory = partition_dir(root, year, month, day)
+   if not append and os.path.isdir(directory):
+      shutil.rmtree(directory)
+   write_part(df, directory, list_columns)
+
+
+def write_dataset(df, root, timestamp_column, append=False, list_columns=()):
+   '''Write df to the Parquet dataset at root, partitioned by the day of
+   timestamp_column; without append, the dataset's existing files are replaced'''
+   if not append and os.path.isdir(root):
+      shutil.rmtree(root)
+   os.makedirs(root, exist_ok=True)
+   if len(df) == 0:
+      return
+   days = pd.to_datetime(df[timestamp_column]).dt.normalize()
+   for day, rows in df.groupby(days):
+      write_partition(rows, root, day.year, day.month, day.day, append=True, list_columns=list_columns)
+
+
+def write_frame(df, path, append=False, list_columns=()):
+   '''Write df to a gzip CSV file, or a single Parquet file if path ends in
+   .parquet, with list_columns stored as lists'''
+   if path.endswith(PART_SUFFIX):
+      check_format(FORMAT_PARQUET)
+      _write_parquet(df, path, list_columns)
+   else:
+      # gzip members concatenate; pandas reads them back as one file
+      df.to_csv(path, mode='a' if append else 'w', header=not append, index=False, compression='gzip')
+
+
+def _unify_schemas(schemas):
+   '''The schema of all of schemas; a column of numbers in some files and
+   strings in others (as a number-or-text column can be) is read as strings'''
+   try:
+      return pyarrow.unify_schemas(schemas, promote_options='permissive')
+   except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+      pass
+   fields = {}
+   for schema in schemas:
+      for field in schema:
+         fields.setdefault(field.name, []).append(field)
+   unified = []
+   for name, same_name in fields.items():
+      try:
+         unified.append(pyarrow.unify_schemas([pyarrow.schema([field]) for field in same_name],
+                                              promote_options='permissive').field(name))
+      except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+         unified.append(same_name[0].with_type(pyarrow.string()))
+   return pyarrow.schema(unified)
+
+
+def _parquet_dataset(path):
+   '''A pyarrow dataset of a Parquet file, or of the part files under a directory.
+
+   Other files (such as the ingestion manifest) and hidden directories (such
+   as unmerged shards) are left out, and the part files' schemas are unified,
+   as a column that was all null in one file has no type of its own there.
+   '''
+   if not os.path.isdir(path):
+      return pads.dataset(path, format='parquet')
+   # glob skips names starting with '.'
+   files = sorted(glob.glob(os.path.join(path, '**', '*' + PART_SUFFIX), recursive=True))
+   partitioning = pads.HivePartitioning.discover(infer_dictionary=False)
+   if not files:
+      return pads.dataset(files, format='parquet')
+   schema = _unify_schemas([pq.read_schema(name) for name in files])
+   dataset = pads.dataset(files, format='parquet', partitioning=partitioning, partition_base_dir=path)
+   for field in dataset.schema:
+      if field.name in PARTITION_KEYS and field.name not in schema.names:
+         schema = schema.append(field)
+   return pads.dataset(files, schema=schema, format='parquet', partitioning=partitioning, partition_base_dir=path)
+
+
+def read_frame(path, columns=None, list_columns=(), date_columns=(), filters=None):
+   '''Read a gzip CSV file, a Parquet file or a Parquet dataset directory.
+
+   columns projects the columns read. list_columns are parsed from their CSV
+   text into lists (Parquet list columns always come back as lists) and
+   date_columns into datetimes. filters (Parquet only, e.g. [('month', '=', 7)])
+   select partitions; partition keys are only returned if listed in columns.
+   '''
+   if not is_parquet(path):
+      return pd.read_csv(path, compression='gzip', usecols=columns,
+                         converters={name: ast.literal_eval for name in list_columns},
+                         parse_dates=list(date_columns))
+   check_format(FORMAT_PARQUET)
+   table = _parquet_dataset(path).to_table(
+      columns=columns, filter=pq.filters_to_expression(filters) if filters else None
+   )
+   fields = []
+   list_fields = []
+   for field in table.schema:
+      if field.name in PARTITION_KEYS and not (columns and field.name in columns):
+         continue
+      # dictionary encoded columns would come back categorical; read them as CSV would
+      if pyarrow.types.is_dictionary(field.type):
+         field = pyarrow.field(field.name, field.type.value_type)
+      if pyarrow.types.is_list(field.type) or pyarrow.types.is_large_list(field.type):
+         list_fields.append(field.name)
+      fields.append(field)
+   table = table.select([field.name for field in fields]).cast(pyarrow.schema(fields))
+   df = table.to_pandas(ignore_metadata=True)
+   for name in list_fields:
+      # numpy arrays otherwise
+      df[name] = df[name].map(list, na_action='ignore')
+   for name in date_columns:
+      if name in df.columns and not pd.api.types.is_datetime64_any_dtype(df[name]):
+         df[name] = pd.to_datetime(df[name])
+   return df
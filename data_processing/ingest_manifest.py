@@ -0,0 +1,91 @@
+'''Persistent record of the log files already ingested by the processing scripts.
+
+For every log file the manifest keeps its size and mtime when it was parsed,
+the parse status ('ok', 'empty' or 'failed') and the output partition its rows
+went to. On a rerun only new files, and files that changed since (spool and
+collector files grow during the day), need parsing again.
+'''
+import os
+import sqlite3
+
+STATUS_OK = 'ok'
+STATUS_EMPTY = 'empty'
+STATUS_FAILED = 'failed'
+
+
+def stat_files(paths):
+   '''[(path, size, mtime_ns)] of the paths that exist'''
+   entries = []
+   for path in paths:
+      try:
+         st = os.stat(path)
+      except OSError:
+         continue
+      entries.append((path, st.st_size, st.st_mtime_ns))
+   return entries
+
+
+def parse_status(rows):
+   '''Status of a parsed file from its rows, or their number: None when it failed to parse'''
+   if rows is None:
+      return STATUS_FAILED
+   count = rows if isinstance(rows, int) else len(rows)
+   return STATUS_OK if count > 0 else STATUS_EMPTY
+
+
+class IngestManifest:
+   def __init__(self, path):
+      self.path = path
+      self._db = sqlite3.connect(path)
+      self._db.execute(
+         'CREATE TABLE IF NOT EXISTS files ('
+         ' path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, status TEXT, partition TEXT)'
+      )
+      self._db.execute('CREATE INDEX IF NOT EXISTS files_partition ON files (partition)')
+
+   def close(self):
+      self._db.close()
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *args):
+      self.close()
+
+   def changes(self, entries):
+      '''(new, changed): the stat_files() entries never ingested or that failed to
+      parse, and those whose size or mtime differ from when they were.
+
+      Failed files are parsed again on every run, as the failure may have been
+      transient (an OSError on a busy filesystem); they added no rows, so they
+      count as new.
+      '''
+      new, changed = [], []
+      for entry in entries:
+         path, size, mtime_ns = entry
+         row = self._db.execute('SELECT size, mtime_ns, status FROM files WHERE path = ?', (path,)).fetchone()
+         if row is None or row[2] == STATUS_FAILED:
+            new.append(entry)
+         elif row[:2] != (size, mtime_ns):
+            changed.append(entry)
+      return new, changed
+
+   def record(self, entries, partition):
+      '''Store (path, size, mtime_ns, status) entries as ingested into partition'''
+      with self._db:
+         self._db.executemany(
+            'INSERT OR REPLACE INTO files (path, size, mtime_ns, status, partition) VALUES (?, ?, ?, ?, ?)',
+            [(path, size, mtime_ns, status, partition) for path, size, mtime_ns, status in entries],
+         )
+
+   def has_partition(self, partition):
+      row = self._db.execute('SELECT 1 FROM files WHERE partition = ? LIMIT 1', (partition,)).fetchone()
+      return row is not None
+
+   def forget_partition(self, partition):
+      '''Drop the entries of partition, before it is rewritten'''
+      with self._db:
+         self._db.execute('DELETE FROM files WHERE partition = ?', (partition,))
+
+   def status_counts(self):
+      return dict(self._db.execute('SELECT status, COUNT(*) FROM files GROUP BY status'))
@@ -0,0 +1,129 @@
+'''PBS job details for the job ids of the module files, from qstat.
+
+Job ids are looked up in batches (many ids per qstat call), with a few calls
+running at once, and the results kept in a persistent SQLite cache keyed by job
+id: finished jobs are cached for good, while jobs still queued or running, and
+ids qstat did not know, are asked again once their entry is older than
+max_age seconds.
+
+The qstat command is a parameter; `replay_qstat.py` answers like qstat from a
+saved `qstat -fx -F json` output, standing in for PBS away from the system.
+'''
+import json
+import shlex
+import sqlite3
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+QSTAT_COMMAND = '/opt/pbs/bin/qstat -fx -F json'
+# job ids per qstat call, and qstat calls at once
+BATCH_SIZE = 100
+MAX_WORKERS = 4
+# job states whose details no longer change
+FINAL_STATES = ('F',)
+# seconds before the cached details of a job not finished are asked for again
+MAX_AGE = 3600
+
+
+def _job_number(job_id):
+   return str(job_id).split('.')[0]
+
+
+def _run_qstat(command, job_ids):
+   '''{job id: details or None} from one qstat call, or None if its output could not be read.
+
+   qstat prints the jobs it knows and exits with an error for the ones it does
+   not; a job may come back under its full id ('1234.pbs-server') when asked
+   for by its number.
+   '''
+   result = subprocess.run(command + [str(job_id) for job_id in job_ids], capture_output=True, text=True)
+   try:
+      jobs = json.loads(result.stdout).get('Jobs', {}) if result.stdout.strip() else {}
+   except ValueError:
+      print(f"Error reading the qstat output for jobs {job_ids[0]}..{job_ids[-1]}: {result.stderr.strip()}")
+      return None
+   if not jobs and result.returncode != 0 and len(job_ids) == 1:
+      print(f"Error running qstat for job {job_ids[0]}: {result.stderr.strip()}")
+   by_number = {_job_number(key): details for key, details in jobs.items()}
+   return {job_id: jobs.get(job_id, by_number.get(_job_number(job_id))) for job_id in job_ids}
+
+
+def _query_batch(command, job_ids):
+   details = _run_qstat(command, job_ids)
+   if details is None and len(job_ids) > 1:
+      # one bad job id must not lose the batch
+      details = {}
+      for job_id in job_ids:
+         details.update(_run_qstat(command, [job_id]) or {})
+   return details or {}
+
+
+def query_jobs(job_ids, command=QSTAT_COMMAND, batch_size=BATCH_SIZE, max_workers=MAX_WORKERS):
+   '''{job id: qstat details of the job, or None} for job_ids. Jobs whose
+   qstat call failed are left out, so they are not cached.'''
+   if isinstance(command, str):
+      command = shlex.split(command)
+   job_ids = list(job_ids)
+   batches = [job_ids[i:i + batch_size] for i in range(0, len(job_ids), batch_size)]
+   details = {}
+   with ThreadPoolExecutor(max_workers=max_workers) as pool:
+      for batch_details in pool.map(lambda batch: _query_batch(command, batch), batches):
+         details.update(batch_details)
+   return details
+
+
+class JobInfoCache:
+   def __init__(self, path):
+      self.path = path
+      self._db = sqlite3.connect(path)
+      self._db.execute(
+         'CREATE TABLE IF NOT EXISTS jobs ('
+         ' job_id TEXT PRIMARY KEY, details TEXT, final INTEGER, fetched REAL)'
+      )
+
+   def close(self):
+      self._db.close()
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *args):
+      self.close()
+
+   def get(self, job_ids, max_age=MAX_AGE):
+      '''{job id: details or None} of the job_ids cached, leaving out the stale entries of jobs not finished'''
+      oldest = time.time() - max_age
+      cached = {}
+      for job_id in job_ids:
+         row = self._db.execute('SELECT details, final, fetched FROM jobs WHERE job_id = ?', (str(job_id),)).fetchone()
+         if row is not None and (row[1] or row[2] >= oldest):
+            cached[job_id] = json.loads(row[0]) if row[0] is not None else None
+      return cached
+
+   def store(self, details):
+      '''Cache {job id: details or None}'''
+      now = time.time()
+      with self._db:
+         self._db.executemany(
+            'INSERT OR REPLACE INTO jobs (job_id, details, final, fetched) VALUES (?, ?, ?, ?)',
+            [
+               (str(job_id), json.dumps(job) if job is not None else None,
+                int(job is not None and job.get('job_state') in FINAL_STATES), now)
+               for job_id, job in details.items()
+            ],
+         )
+
+
+def lookup_jobs(job_ids, cache=None, command=QSTAT_COMMAND, batch_size=BATCH_SIZE, max_workers=MAX_WORKERS, max_age=MAX_AGE):
+   '''{job id: qstat details of the job, or None}, asking qstat only for the
+   job ids not in cache (a JobInfoCache, if given)'''
+   job_ids = list(dict.fromkeys(job_ids))
+   details = cache.get(job_ids, max_age) if cache is not None else {}
+   missing = [job_id for job_id in job_ids if job_id not in details]
+   if missing:
+      fetched = query_jobs(missing, command, batch_size, max_workers)
+      if cache is not None:
+         cache.store(fetched)
+      details.update(fetched)
+   return details
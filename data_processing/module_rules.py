@@ -0,0 +1,105 @@
+'''Module and host classification rules of the processing scripts.
+
+The rule files are categories.json ({category: [modules]}), ignore_modules.json
+and exclude_modules.json ([modules]) and system_nodes.json ({system: [node name
+fragments]}). ModuleRules compiles them once for all the lookups of a run:
+
+- a module name also covers its submodules ('tensorflow' covers
+  'tensorflow.keras'): the name and each of its dotted prefixes are looked up
+  in a dict
+- names with glob characters ('torch_*') are patterns, compiled into one
+  regex per category or list
+- a module may be in several categories; `categories` gives them all and
+  `category` the first listed
+- a hostname maps to the first system with one of its node fragments in it
+
+Results are cached per module and hostname, as the same few repeat over all
+the records.
+'''
+import fnmatch
+import json
+import re
+
+NO_CATEGORY = 'none'
+GLOB_CHARS = '*?['
+
+
+class ModuleMatcher:
+   '''Labels of the module names and glob patterns matching a module, in the order the labels were first given'''
+   def __init__(self, labelled_names):
+      self._names = {}
+      self._order = {}
+      patterns = {}
+      for label, name in labelled_names:
+         self._order.setdefault(label, len(self._order))
+         if any(c in name for c in GLOB_CHARS):
+            patterns.setdefault(label, []).append(fnmatch.translate(name))
+         else:
+            self._names.setdefault(name, []).append(label)
+      self._patterns = [(label, re.compile('|'.join(regexes))) for label, regexes in patterns.items()]
+      self._cache = {}
+
+   def match(self, module):
+      labels = self._cache.get(module)
+      if labels is None:
+         found = set()
+         name = module
+         while name:
+            found.update(self._names.get(name, ()))
+            name = name.rpartition('.')[0]
+         found.update(label for label, pattern in self._patterns if pattern.match(module))
+         labels = tuple(sorted(found, key=self._order.__getitem__))
+         self._cache[module] = labels
+      return labels
+
+
+class ModuleRules:
+   def __init__(self, categories=None, ignore=(), exclude=(), system_nodes=None):
+      categories = categories or {}
+      system_nodes = system_nodes or {}
+      self.category_names = list(categories)
+      self.systems = list(system_nodes)
+      self._categories = ModuleMatcher((category, module) for category, modules in categories.items() for module in modules)
+      self._ignore = ModuleMatcher((True, module) for module in ignore)
+      self._exclude = ModuleMatcher((True, module) for module in exclude)
+      self._system_patterns = [
+         (system, re.compile('|'.join(re.escape(node) for node in nodes)))
+         for system, nodes in system_nodes.items() if nodes
+      ]
+      self._host_system = {}
+
+   @classmethod
+   def from_files(cls, categories=None, ignore=None, exclude=None, system_nodes=None):
+      '''Rules from the paths of the rule files; a rule file not given has no rules'''
+      def load(path, default):
+         if not path:
+            return default
+         with open(path) as f:
+            return json.load(f)
+      return cls(load(categories, {}), load(ignore, []), load(exclude, []), load(system_nodes, {}))
+
+   def categories(self, module):
+      '''All the categories of module, in the order of the categories file'''
+      return self._categories.match(module)
+
+   def category(self, module):
+      '''The first category of module, in the order of the categories file, or "none"'''
+      categories = self._categories.match(module)
+      return categories[0] if categories else NO_CATEGORY
+
+   def is_ignored(self, module):
+      '''True for modules left out of the module counts: listed, private or submodules'''
+      return module.startswith('_') or '.' in module or bool(self._ignore.match(module))
+
+   def is_excluded(self, module):
+      return bool(self._exclude.match(module))
+
+   def system(self, hostname):
+      '''The system hostname belongs to, or None'''
+      try:
+         return self._host_system[hostname]
+      except KeyError:
+         pass
+      system = next((system for system, pattern in self._system_patterns if pattern.search(hostname)), None)
+      self._host_system[hostname] = system
+      return system
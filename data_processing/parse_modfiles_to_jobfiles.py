@@ -2,9 +2,13 @@ import pandas as pd
 import argparse
 import glob
 import os
-import subprocess
-import json
 import dateparser
+from frame_io import partition_dir, partition_exists, read_frame, split_partition_dir, write_frame, write_partition
+from job_info import BATCH_SIZE, MAX_AGE, MAX_WORKERS, QSTAT_COMMAND, JobInfoCache, lookup_jobs
+from module_rules import NO_CATEGORY, ModuleRules
+
+# columns of lists, stored as lists in Parquet output
+LIST_COLUMNS = ['Categories', 'Non-Ignored Modules']
 
 PBS_JOB_STATE_MAP = {
    'B': 'Array Running',
@@ -31,22 +35,6 @@ def get_seconds(time_str):
    else:
       return 0
 
-def get_job_info_as_json(job_id):
-   try:
-      # Run the qstat command with the given job_id and capture the output
-      result = subprocess.run(
-         ["/opt/pbs/bin/qstat", "-fx", "-F", "json", str(job_id)],
-         capture_output=True, text=True, check=True
-      )
-
-      # Parse the output as JSON
-      json_output = json.loads(result.stdout)
-      return json_output
-   except subprocess.CalledProcessError as e:
-      print(f"Error running qstat for job {job_id}: {e}")
-      return None
-
-
 # def process_dataframe_old(df):
 #    # A helper function to aggregate module categories and distinct non-ignored modules
 #    def agg_func(x):
@@ -76,24 +64,35 @@ def get_job_info_as_json(job_id):
 
 #    return result
 
-def process_dataframe(df):
+def job_categories(modules, rules):
+   '''Every category of the modules, first seen first, without "none"'''
+   categories = {}
+   for module in modules:
+      categories.update(dict.fromkeys(rules.categories(module)))
+   categories.pop(NO_CATEGORY, None)
+   return list(categories)
+
+def process_dataframe(df, job_info, rules=None):
+   '''One row per job of the module rows of df; job_info is {job id: qstat
+   details} of its jobs, from lookup_jobs. With rules (a ModuleRules), a job's
+   Categories are all those of its modules, else their primary Category'''
    def agg_func(x):
       output = pd.Series([['none'], [], None, None, None, None, None, None, None], 
                         index=['Categories', 'Non-Ignored Modules', 'Filesystems', 'Award Category', 'Walltime', 'Nodes', 'Runtime', 'Exit Status', 'Job State'])
       if len(x) > 0:
       
-         categories = [cat for cat in x['Category'].unique().tolist() if cat != 'none']
+         if rules is not None:
+            categories = job_categories(x['Module'].unique().tolist(), rules)
+         else:
+            categories = [cat for cat in x['Category'].unique().tolist() if cat != 'none']
          
          if not categories:
             categories = ['none']
          
          non_ignored_modules = x[x['Ignored'] == False]['Module'].unique().tolist()
          
-         job_data = get_job_info_as_json(x['Job ID'].iloc[0])
-         if job_data:
-            key = list(job_data["Jobs"].keys())[0]
-            job_details = job_data["Jobs"][key]
-            
+         job_details = job_info.get(x['Job ID'].iloc[0])
+         if job_details:
             # Extract required data from Resource_List and resources_used
             filesystems = job_details.get("Resource_List", {}).get("filesystems", None)
             award_category = job_details.get("Resource_List", {}).get("award_category", None)
@@ -127,32 +126,62 @@ def process_dataframe(df):
    for col in job_cols:
       result[col] = df.groupby('Job ID')[col].first()
 
+   # cost of the logged processes, from module files with the resource columns;
+   # jobs without any resource summary (records older than it) get NaN, not 0
+   if 'CPU Seconds' in df:
+      processes = df.drop_duplicates(['Job ID', 'Hostname', 'PID', 'Timestamp']).groupby('Job ID')
+      result['CPU Hours'] = processes['CPU Seconds'].sum(min_count=1) / 3600
+      result['Max RSS GB'] = processes['Max RSS KB'].max() / 2**20
+
    return result.reset_index()
 
 if __name__ == "__main__":
-   parser = argparse.ArgumentParser(description="Aggregate DataFrame based on unique Job ID.")
-   parser.add_argument("-g", "--input_glob", help="Glob pattern to select the input compressed CSV files.")
-   parser.add_argument("-p", "--postfix", default="_byjob", help="Postfix to append to the output filenames.")
-
+   parser = argparse.ArgumentParser(description="""
+Aggregate DataFrame based on unique Job ID. Day directories of a Parquet dataset
+(<root>/year=YYYY/month=MM/day=DD) are written to the same day of <root><postfix>.
+""")
+   parser.add_argument("-g", "--input_glob", help="Glob pattern to select the input compressed CSV files or Parquet day directories.")
+   parser.add_argument("-p", "--postfix", default="_byjob", help="Postfix to append to the output filenames, or Parquet dataset directory.")
+
+   parser.add_argument("-c", "--category", help="JSON file defining module categories, as given to process_logfiles.py; each job then gets every category of its modules, not only their first. [DEFAULT=the Category column]", default=None)
    parser.add_argument("--overwrite",action="store_true",help="overwrite existing output files.",default=False)
+   parser.add_argument("--job-cache", default="job_info.sqlite", help="SQLite cache of the qstat job details. [DEFAULT=job_info.sqlite]")
+   parser.add_argument("--max-age", type=float, default=MAX_AGE, help=f"Seconds the cached details of jobs not finished are used before qstat is asked again; finished jobs are cached for good. [DEFAULT={MAX_AGE}]")
+   parser.add_argument("--qstat", default=QSTAT_COMMAND, help=f"qstat command the job ids are appended to, e.g. 'python replay_qstat.py jobs.json'. [DEFAULT={QSTAT_COMMAND}]")
+   parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help=f"Job ids per qstat call. [DEFAULT={BATCH_SIZE}]")
+   parser.add_argument("--qstat-workers", type=int, default=MAX_WORKERS, help=f"qstat calls run at once. [DEFAULT={MAX_WORKERS}]")
 
    args = parser.parse_args()
+   job_cache = JobInfoCache(args.job_cache)
+   rules = ModuleRules.from_files(categories=args.category) if args.category else None
 
    # Iterate over the files matched by the glob
    for file in sorted(glob.glob(args.input_glob)):
-      output_filename = file.replace('.csv.gz', args.postfix + '.csv.gz')
-      if os.path.exists(output_filename) and not args.overwrite:
+      partition = split_partition_dir(file)
+      if partition:
+         root, day = partition
+         output_filename = partition_dir(root.rstrip(os.sep) + args.postfix, *day)
+         output_exists = partition_exists(output_filename)
+      else:
+         output_filename = file.replace('.csv.gz', args.postfix + '.csv.gz')
+         output_exists = os.path.exists(output_filename)
+      if output_exists and not args.overwrite:
          print(f"File exists: {output_filename}")
          continue
       
       # Read the compressed CSV file
-      df = pd.read_csv(file, compression='gzip')
+      df = read_frame(file)
       
       if len(df) > 0 and len(df['Job ID'].unique()) > 1:
-         processed_df = process_dataframe(df)
-
-         # Create the output filename by replacing the existing ".csv.gz" with the postfix + ".csv.gz"
-         processed_df.to_csv(output_filename, index=False, compression='gzip')
+         job_info = lookup_jobs(df['Job ID'].unique(), job_cache, args.qstat, args.batch_size, args.qstat_workers, args.max_age)
+         processed_df = process_dataframe(df, job_info, rules)
+
+         if partition:
+            write_partition(processed_df, root.rstrip(os.sep) + args.postfix, *day, list_columns=LIST_COLUMNS)
+         else:
+            # Create the output filename by replacing the existing ".csv.gz" with the postfix + ".csv.gz"
+            write_frame(processed_df, output_filename, list_columns=LIST_COLUMNS)
          print(f"Processed data from {file} saved to {output_filename}.")
       else:
          print(f"File {file} contains an emtpy dataframe or no job ids")
+   job_cache.close()
@@ -3,9 +3,12 @@ import os,sys,json,time
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-import concurrent.futures
 import multiprocessing as mp
-import argparse,logging
+import argparse,datetime,logging
+from snooper_records import log_tree_files, read_records
+from ingest_manifest import IngestManifest, parse_status
+from module_rules import ModuleRules
+from frame_io import FORMAT_CSV, FORMAT_PARQUET, FORMATS, check_format, read_frame, write_dataset, write_frame
 
 DEFAULT_NUM_PROCS = int(mp.cpu_count() * 0.9)
 DEFAULT_YEARS = '2020'
@@ -15,14 +18,18 @@ DEFAULT_OUTPUT = 'output.csv.gz'
 DEFAULT_EXCLUDED_FILENAME = 'exclude_modules.json'
 DEFAULT_SYSTEM_NODES_FILENAME = 'system_nodes.json'
 DEFAULT_SOURCE_MAP_FILENAME = 'source_map.json'
+# files handed to a parsing process at a time
+PARSE_CHUNKSIZE = 16
+# files between progress messages
+PROGRESS_FILES = 10000
+# columns of lists, stored as lists in Parquet output
+LIST_COLUMNS = ['modules']
 
 logger = logging.getLogger(__name__)
-exclude_modules = None
-system_nodes = None
-gconfig = {}
+rules = None
 
 def main():
-   global exclude_modules,system_nodes,gconfig
+   global rules
    ''' simple starter program that can be copied for use when starting a new script. '''
    logging_format = '%(asctime)s %(levelname)s:%(name)s:%(message)s'
    logging_datefmt = '%Y-%m-%d %H:%M:%S'
@@ -39,21 +46,31 @@ def main():
                        default=DEFAULT_MONTHS)
    parser.add_argument('-d','--days',help='Days of the Month to include, separated by comma. \
                        [DEFAULT=%s]' % DEFAULT_DAYS,default=DEFAULT_DAYS)
-   parser.add_argument('-o','--output',help='Output data file name. Written as gzipped CSV. \
-                       [DEFAULT=%s' % DEFAULT_OUTPUT,default=DEFAULT_OUTPUT)
+   parser.add_argument('--since',help='Only include days from this date on, e.g. 2023-07-15. [DEFAULT=None]',
+                       type=datetime.date.fromisoformat,default=None)
+   parser.add_argument('-o','--output',help='Output data file name. Written as gzipped CSV, or as a \
+                       Parquet dataset directory with --format parquet. [DEFAULT=%s' % DEFAULT_OUTPUT,default=DEFAULT_OUTPUT)
 
    parser.add_argument('--excluded',help='Path to a json file containing a list of modules to exclude from \
                        the output. [DEFAULT=%s' % DEFAULT_EXCLUDED_FILENAME,default=DEFAULT_EXCLUDED_FILENAME)
    parser.add_argument('--sysnodes',help='Path to a json file containing a dictionary of lists that map node \
                        names to HPC names. [DEFAULT=%s' % DEFAULT_SYSTEM_NODES_FILENAME,default=DEFAULT_SYSTEM_NODES_FILENAME)
    parser.add_argument('--srcmap',help='Path to which to dump the source map which labels each python environment. [DEFAULT=%s' % DEFAULT_SOURCE_MAP_FILENAME,default=DEFAULT_SOURCE_MAP_FILENAME)
+   parser.add_argument('--manifest',help='Path to an SQLite ingestion manifest. When set, only log files that are new or \
+                       changed since the last run are parsed and the output is updated in place. [DEFAULT=None]',default=None)
 
+   parser.add_argument('-f','--format',choices=FORMATS,default=FORMAT_CSV,help='Output format; parquet writes \
+                       the output as a directory of Parquet files partitioned by day (needs pyarrow). [DEFAULT=%s]' % FORMAT_CSV)
    parser.add_argument('--debug', dest='debug', default=False, action='store_true', help="Set Logger to DEBUG")
    parser.add_argument('--error', dest='error', default=False, action='store_true', help="Set Logger to ERROR")
    parser.add_argument('--warning', dest='warning', default=False, action='store_true', help="Set Logger to ERROR")
    parser.add_argument('--logfilename',dest='logfilename',default=None,
                        help='if set, logging information will go to file')
    args = parser.parse_args()
+   try:
+      check_format(args.format)
+   except ImportError as e:
+      parser.error(str(e))
 
    if args.debug and not args.error and not args.warning:
       logging_level = logging.DEBUG
@@ -84,21 +101,20 @@ def main():
    logger.info('years      = %s',args.years)
    logger.info('months     = %s',args.months)
    logger.info('days       = %s',args.days)
+   logger.info('since      = %s',args.since)
    logger.info('output     = %s',args.output)
    logger.info('numprocs   = %s',args.numprocs)
    logger.info('excluded   = %s',args.excluded)
    logger.info('sysnodes   = %s',args.sysnodes)
    start = time.time()
-   exclude_modules = json.load(open(args.excluded))
-   system_nodes = json.load(open(args.sysnodes))
-   gconfig['years'] = years
-   gconfig['months'] = months
-   gconfig['days'] = days
-   gconfig['path'] = args.logdir
-
-   ds = build_dataset(args.logdir,args.numprocs,years,months,days)
+   rules = ModuleRules.from_files(exclude=args.excluded,system_nodes=args.sysnodes)
 
-   ds.to_csv(args.output,index=False,compression='gzip')
+   if args.manifest:
+      with IngestManifest(args.manifest) as manifest:
+         update_dataset(args.output,args.srcmap,manifest,args.logdir,args.numprocs,years,months,days,args.format,args.since)
+   else:
+      ds = build_dataset(args.logdir,args.numprocs,years,months,days,args.since)
+      write_output(ds,args.output,args.format)
    
    json.dump(gsource_map,open(args.srcmap,'w'),sort_keys=True, indent=3)
 
@@ -125,133 +141,90 @@ def commonize_source(source):
       return ''
 
 
+# the record fields parse_record reads
+RECORD_FIELDS = {'sys.executable': None, 'modules': None}
+
 def parse_datafile(filename):
+   ''' returns one output dict per record; spool files flushed by flush_spool.py hold many '''
    try:
-      data = json.load(open(filename))
+      records = list(read_records(filename, RECORD_FIELDS))
    except:
       print(f'failed to parse filename: {filename}')
-      return {}
+      return None
+   return [parse_record(data,filename) for data in records]
+
+
+def parse_record(data,filename):
    output_data = {}
    output_data['hostname'] = data['hostname']
-   output_data['hpcname'] = 'NA'
-
-   for system,nodes in system_nodes.items():
-      output_data[system] = 0
-      for node in nodes:
-         if node in data['hostname']:
-            output_data[system] = 1
-            output_data['hpcname'] = system
-            break
-      if output_data[system]:
-         break
+   system = rules.system(data['hostname'])
+   output_data['hpcname'] = system or 'NA'
+   for name in rules.systems:
+      output_data[name] = int(name == system)
    output_data['filename'] = filename
    output_data['source'] = commonize_source(data['sys.executable'])
    output_data['timestamp'] = pd.Timestamp(data['timestamp'])
-   modules = []
-   module_keys = data['modules'].keys()
-   # remove submodules
-   module_keys = [x.split('.')[0] for x in module_keys]
-   # keep unique keys only
-   module_keys = list(set(module_keys))
-   
-   # loop over modules, remove any from `/tmp`
+   # remove submodules, keeping unique keys only
+   module_keys = {x.split('.')[0] for x in data['modules']}
+
+   # remove any module loaded from `/tmp`
    for module_name,module_filename in data['modules'].items():
-      if module_filename is None:
-         continue
-      if module_filename.startswith('/tmp/'):
-         try:
-            module_keys.remove(module_name.split('.')[0])
-         except ValueError:
-            #print(module_name,module_filename)
-            continue
-         except KeyError:
-            #print(module_name,module_filename)
-            continue
-   sys.stdout.flush()
-   sys.stderr.flush()
+      if module_filename is not None and module_filename.startswith('/tmp/'):
+         module_keys.discard(module_name.split('.')[0])
 
    # remove excluded modules
-   for module_name in exclude_modules:
-      try:
-         module_keys.remove(module_name)
-      except ValueError:
-         continue
-      except KeyError:
-         continue
-   output_data['modules'] = list(module_keys)
+   output_data['modules'] = [x for x in module_keys if not rules.is_excluded(x)]
    return output_data
 
 
-def make_each_file_list(walk_inputs):
-   root,dirs,files = walk_inputs
-   years = gconfig['years']
-   months = gconfig['months']
-   days = gconfig['days']
-   path = gconfig['path']
-
-   filelist = []
-   logger.debug('root: %s',root)
-   rr = root.replace(path,'')
-   logger.debug('rr: %s',rr)
-   rr = rr.split('/')
-   logger.debug('rr: %s',rr)
-   if rr and len(rr) == 3:
-      year = int(rr[0])
-      month = int(rr[1])
-      day = int(rr[2])
-      if(((len(years) > 0 and year in years) or len(years) == 0) and
-         ((len(months) > 0 and month in months) or len(months) == 0) and
-         ((len(days) > 0 and day in days) or len(days) == 0)):
-         logger.info('%04d-%02d-%02d',year,month,day)
-         logger.info('%s #dirs: %s #files: %s',root,len(dirs),len(files))
-         for file in files:
-               filename = os.path.join(root,file)
-               if os.stat(filename).st_size == 0:
-                  continue
-               
-               filelist.append(filename)
-   return filelist
-
-def get_file_list(path,nprocs,years=[],months=[],days=[]):
-   filelist = []
-   logger.debug('get_file_list: path=%s years=%s months=%s days=%s',path,years,months,days)
-   if not path.endswith('/'):
-      path = path + '/'
-
-   with concurrent.futures.ThreadPoolExecutor(max_workers=nprocs) as pool:
-      for each_filelist in pool.map(make_each_file_list,os.walk(path),chunksize=100):
-         filelist += each_filelist
-
-   return filelist
-
-
-def get_source_id(dataset):
+def get_file_list(path,years=[],months=[],days=[],since=None):
+   ''' yields the paths of the non-empty log files of the selected days (from
+   since on, if set), only listing the directories of those days '''
+   logger.debug('get_file_list: path=%s years=%s months=%s days=%s since=%s',path,years,months,days,since)
+   return (filename for filename,_,_ in log_tree_files(path,years,months,days,since))
+
+
+def init_worker(worker_rules):
+   ''' gives the parsing processes the rules main() loaded '''
+   global rules
+   rules = worker_rules
+
+
+def get_source_id(dataset,source_map=None):
+   ''' label each source; sources in source_map (from an earlier run) keep their id '''
    global gsource_map
-   unique_source = list(set(dataset['source'].to_list()))
-   gsource_map = {unique_source[i]:i for i in range(len(unique_source))}
+   gsource_map = dict(source_map or {})
+   for source in set(dataset['source'].to_list()):
+      gsource_map.setdefault(source,len(gsource_map))
    return dataset['source'].replace(gsource_map)
 
 
-def build_dataset(path,nprocs,years=[],months=[],days=[]):
-   #dataset = pd.DataFrame()
-   filelist = get_file_list(path,nprocs,years,months,days)
-   logger.info(f'{len(filelist)} files')
-   with concurrent.futures.ThreadPoolExecutor(max_workers=nprocs) as pool:
-      total_files = len(filelist)
-      one_percent = int(total_files * 0.01)
+def parse_files(filelist,nprocs):
+   ''' returns the output dicts of all files and the parse status of each file;
+   filelist may be a generator, parsing starts with its first files '''
+   # parsing is CPU bound: processes, not threads
+   with mp.Pool(nprocs,initializer=init_worker,initargs=(rules,)) as pool:
       file_counter = 0
       start = time.time()
       outputs = []
-      for data in pool.map(parse_datafile,filelist,chunksize=100):
-         if len(data) > 0:
-            outputs.append(data)
-            file_counter += 1
-            if file_counter % one_percent == 0:
-               files_per_sec = one_percent / (time.time() - start)
-               percent_done = int(file_counter / total_files * 100)
-               logger.info('percent done: %3d%%   files/second: %10.2f',percent_done,files_per_sec)
-               sys.stderr.flush()
-               start = time.time()
+      statuses = []
+      for data in pool.imap(parse_datafile,filelist,chunksize=PARSE_CHUNKSIZE):
+         statuses.append(parse_status(data))
+         file_counter += 1
+         if data:
+            outputs += data
+         if file_counter % PROGRESS_FILES == 0:
+            files_per_sec = PROGRESS_FILES / (time.time() - start)
+            logger.info('files parsed: %10d   files/second: %10.2f',file_counter,files_per_sec)
+            sys.stderr.flush()
+            start = time.time()
+   logger.info('%d files parsed',file_counter)
+   return outputs,statuses
+
+
+def build_dataset(path,nprocs,years=[],months=[],days=[],since=None):
+   #dataset = pd.DataFrame()
+   outputs,_ = parse_files(get_file_list(path,years,months,days,since),nprocs)
    start = time.time()
    dataset = pd.DataFrame(outputs)
    logger.info('dataset created: %10.2f',time.time() - start)
@@ -259,5 +232,43 @@ def build_dataset(path,nprocs,years=[],months=[],days=[]):
    return dataset
 
 
+def write_output(dataset,output,output_format,append=False):
+   if output_format == FORMAT_PARQUET:
+      write_dataset(dataset,output,'timestamp',append=append,list_columns=LIST_COLUMNS)
+   else:
+      write_frame(dataset,output,append=append,list_columns=LIST_COLUMNS)
+
+
+def update_dataset(output,srcmap,manifest,path,nprocs,years=[],months=[],days=[],output_format=FORMAT_CSV,since=None):
+   ''' parse the log files that are new or changed since the manifest was last updated
+   (or that failed to parse then), and add their rows to output, replacing the rows
+   of changed files '''
+   global gsource_map
+   entries = list(log_tree_files(path,years,months,days,since))
+   output_exists = os.path.exists(output)
+   if output_exists:
+      new,changed = manifest.changes(entries)
+      gsource_map = json.load(open(srcmap)) if os.path.exists(srcmap) else {}
+   else:
+      new,changed = entries,[]
+      gsource_map = {}
+   to_parse = new + changed
+   logger.info('%d files: %d new, %d changed',len(entries),len(new),len(changed))
+   outputs,statuses = parse_files([filename for filename,_,_ in to_parse],nprocs)
+   dataset = pd.DataFrame(outputs)
+
+   if changed:
+      previous = read_frame(output)
+      previous = previous[~previous['filename'].isin([filename for filename,_,_ in changed])]
+      dataset = pd.concat([previous.drop(columns='source_id'),dataset],ignore_index=True)
+      dataset['source_id'] = get_source_id(dataset,gsource_map)
+      write_output(dataset,output,output_format)
+   elif len(dataset) > 0 or not output_exists:
+      dataset['source_id'] = get_source_id(dataset,gsource_map) if len(dataset) > 0 else []
+      write_output(dataset,output,output_format,append=output_exists)
+   manifest.record([entry + (status,) for entry,status in zip(to_parse,statuses)],os.path.basename(output))
+   return dataset
+
+
 if __name__ == "__main__":
    main()
@@ -2,6 +2,7 @@ import pandas as pd
 import argparse
 import glob
 import matplotlib.pyplot as plt
+from frame_io import read_frame
 
 def plot_categories(df, filename, accounts_to_exclude=None, users_to_exclude=None):
    # Filter out the DataFrame based on provided account names and user names to exclude
@@ -300,6 +301,32 @@ def plot_module_usage_by_account(df, filename, accounts_to_exclude=None, users_t
    plt.savefig(filename)
    plt.close()
 
+def plot_module_cpu_hours(df, filename, accounts_to_exclude=None, users_to_exclude=None, top=20):
+   if accounts_to_exclude:
+      df = df[~df['Account'].isin(accounts_to_exclude)]
+   if users_to_exclude:
+      df = df[~df['User'].isin(users_to_exclude)]
+   if 'CPU Hours' not in df:
+      print(f"No CPU Hours column, skipping {filename}")
+      return
+
+   # one row per module used by each job
+   exploded = df.assign(Module=df['Non-Ignored Modules']).explode('Module').dropna(subset=['Module'])
+   per_module = exploded.groupby('Module').agg({'CPU Hours': 'sum', 'Max RSS GB': 'mean'})
+   per_module = per_module.sort_values('CPU Hours', ascending=False).head(top)
+
+   fig, (ax_cpu, ax_mem) = plt.subplots(1, 2, figsize=(16, 6))
+   per_module['CPU Hours'].plot(kind='bar', ax=ax_cpu)
+   ax_cpu.set_title(f'CPU-Hours of Jobs Using Each Module (top {top})')
+   ax_cpu.set_ylabel('CPU-Hours')
+   ax_cpu.set_yscale("log")
+   per_module['Max RSS GB'].plot(kind='bar', ax=ax_mem)
+   ax_mem.set_title('Mean Peak Memory of Jobs Using Each Module')
+   ax_mem.set_ylabel('Peak RSS (GB)')
+   plt.tight_layout()
+   plt.savefig(filename)
+   plt.close()
+
 def plot_queue_node_hours(df, filename, accounts_to_exclude=None, users_to_exclude=None):
    if accounts_to_exclude:
       df = df[~df['Account'].isin(accounts_to_exclude)]
@@ -336,7 +363,7 @@ def plot_queue_node_hours(df, filename, accounts_to_exclude=None, users_to_exclu
 
 if __name__ == "__main__":
    parser = argparse.ArgumentParser(description="Generate plots from processed job data.")
-   parser.add_argument("-g", "--input_glob", help="Glob pattern to select the input CSV files. Can be multiple",action="append",required=True)
+   parser.add_argument("-g", "--input_glob", help="Glob pattern to select the input CSV files or Parquet datasets. Can be multiple",action="append",required=True)
    parser.add_argument("-o", "--output_prefix", help="Output prefix for generated plot files.",required=True)
    args = parser.parse_args()
 
@@ -346,7 +373,7 @@ if __name__ == "__main__":
       filelist = glob.glob(glob_str)
       for file in sorted(filelist):
          print(f"Reading data from {file}...")
-         all_data.append(pd.read_csv(file, compression='gzip', converters={'Categories': eval}, parse_dates=['Timestamp']))
+         all_data.append(read_frame(file, list_columns=['Categories', 'Non-Ignored Modules'], date_columns=['Timestamp']))
    
    df = pd.concat(all_data, ignore_index=True)
    print(f"Combined data from {len(all_data)} files into one DataFrame.")
@@ -380,6 +407,7 @@ if __name__ == "__main__":
    plot_module_usage_node_hours(df, f"{args.output_prefix}_module_usage_node_hours.png", accounts_to_exclude=accounts_to_exclude)
    plot_module_usage_by_account(df,f"{args.output_prefix}_module_usage_by_account.png", accounts_to_exclude=accounts_to_exclude)
    plot_queue_node_hours(df, f"{args.output_prefix}_queue_node_hours.png", accounts_to_exclude=accounts_to_exclude)
+   plot_module_cpu_hours(df, f"{args.output_prefix}_module_cpu_hours.png", accounts_to_exclude=accounts_to_exclude)
    
 
    
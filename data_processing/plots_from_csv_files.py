@@ -6,6 +6,7 @@ import matplotlib.pyplot as plt
 import concurrent.futures
 import multiprocessing as mp
 import argparse,logging
+from frame_io import is_dataset, partition_filters, read_frame
 
 DEFAULT_NUM_PROCS = int(mp.cpu_count() * 0.9)
 DEFAULT_YEARS = '2021'
@@ -24,7 +25,8 @@ def main():
    logging_level = logging.INFO
    
    parser = argparse.ArgumentParser(description='This script will walk the PyModuleSnooper log directory structure, parse the json files therein, and dump compressed format files.')
-   parser.add_argument('-l','--logdir',help='Path to the csv.gz files.',required=True)
+   parser.add_argument('-l','--logdir',help='Path to the csv.gz files, or to a Parquet dataset written by \
+                       parse_snooper_data.py --format parquet.',required=True)
    parser.add_argument('-n','--numprocs',help='Number of parallel processes to \
                        use to parse json files. [DEFAULT=%s]' % DEFAULT_NUM_PROCS,
                        type=int,default=DEFAULT_NUM_PROCS)
@@ -77,11 +79,15 @@ def main():
 
    start = time.time()
 
-   filelist = get_file_list(args.logdir,years,months,days)
+   if is_dataset(args.logdir):
+      # only the selected days' partitions are read
+      dataset = read_frame(args.logdir,filters=partition_filters(years,months,days),date_columns=['timestamp'])
+   else:
+      filelist = get_file_list(args.logdir,years,months,days)
 
-   logger.info('number of files: %s',len(filelist))
+      logger.info('number of files: %s',len(filelist))
 
-   dataset = build_dataset(filelist,args.numprocs)
+      dataset = build_dataset(filelist,args.numprocs)
 
    source_map = get_source_id(dataset)
    logger.info('source_map: \n %s\n',source_map)
@@ -1,99 +1,217 @@
 import pandas as pd
-import json
 import argparse
-import glob
+import datetime
 from multiprocessing import Pool
 import os
+import shutil
+import tempfile
+from snooper_records import day_log_files, log_day_dirs, module_versions, read_records
+from ingest_manifest import IngestManifest, parse_status, stat_files
+from module_rules import ModuleRules
+from frame_io import FORMAT_PARQUET, FORMATS, check_format, partition_dir, partition_exists, write_frame, write_part, write_partition
 
-def extract_data_from_log(log_filename, ignore_modules, categories):
+# output columns, in order
+COLUMNS = [
+   "Module", "Version", "User", "Hostname", "Timestamp", "Python Executable", "Ignored",
+   "Job ID", "Queue", "Job Size", "Account", "Node Number", "Job Name", "Job Directory",
+   "PALS Depth", "PALS Rank ID", "PALS Local Rank ID", "PALS Node ID",
+   "PMI Local Rank", "PMI Local Size", "PMI Rank", "PMI Size", "PID",
+   "Wall Seconds", "CPU Seconds", "Max RSS KB", "Threads", "Category",
+]
+# columns whose values are all strings repeat a few values over many rows; as
+# categoricals a worker's frame is mostly small integer codes. User and Job Size
+# can hold other types and stay object columns
+COLUMN_DTYPES = {
+   "Ignored": "bool",
+   "PID": "Int64",
+   "Wall Seconds": "float64",
+   "CPU Seconds": "float64",
+   "Max RSS KB": "Int64",
+   "Threads": "Int64",
+   "User": "object",
+   "Job Size": "object",
+}
+# most files parsed by one worker task, returned as one frame
+FILES_PER_BATCH = 200
+
+def record_columns(log_data):
+   '''{column: value} of the columns that are the same for every module of a
+   record, or None for login node runs, which are ignored'''
+   env = log_data["env"]
+   resources = log_data.get("resources", {})
+   cpu_seconds = None
+   if "user_s" in resources:
+      cpu_seconds = resources["user_s"] + resources["sys_s"]
+   queue_name = "N/A"
+   account = "N/A"
+   nodenum = "N/A"
+   job_name = "N/A"
+   job_dir = "N/A"
+
+   if "PBS_JOBID" in env:
+      queue_name = env.get("PBS_QUEUE", "N/A")
+      account = env.get("PBS_ACCOUNT","N/A")
+      nodenum = env.get("PBS_NODENUM","N/A")
+      job_name = env.get("PBS_JOBNAME","N/A")
+      job_dir = env.get("PBS_JOBDIR","N/A")
+   elif "COBALT_JOBID" in env:
+      queue_name = env.get("COBALT_QUEUE", "N/A")
+      account = env.get("COBALT_ACCOUNT","N/A")
+      job_name = env.get("COBALT_JOBNAME","N/A")
+   elif "login" in log_data["hostname"]:
+      # ignore login node runs
+      return None
+
+   return {
+      "User": env.get("USER",env.get('PBS_O_LOGNAME',str(env.get('HOME')).split('/')[-1])),
+      "Hostname": log_data["hostname"],
+      "Timestamp": log_data["timestamp"],
+      "Python Executable": log_data["sys.executable"],
+      # PMI variables set by MPICH when running MPI
+      "Job ID": env.get("PMI_JOBID","N/A"),
+      "Queue": queue_name,
+      "Job Size": env.get("PMI_SIZE",env.get("WORLD_SIZE",env.get("NRANKS",env.get("NUMRANKS",1)))),
+      "Account": account,
+      "Node Number": nodenum,
+      "Job Name": job_name,
+      "Job Directory": job_dir,
+      "PALS Depth": env.get("PALS_DEPTH","N/A"),
+      "PALS Rank ID": env.get("PALS_RANKID","N/A"),
+      "PALS Local Rank ID": env.get("PALS_LOCAL_RANKID","N/A"),
+      "PALS Node ID": env.get("PALS_NODEID","N/A"),
+      "PMI Local Rank": env.get("PMI_LOCAL_RANK","N/A"),
+      "PMI Local Size": env.get("PMI_LOCAL_SIZE","N/A"),
+      "PMI Rank": env.get("PMI_RANK","N/A"),
+      "PMI Size": env.get("PMI_SIZE","N/A"),
+      "PID": log_data.get("pid"),
+      # process cost, in records written since the resource summary was added;
+      # wall time runs from the hook's import during interpreter startup to the
+      # record, so it leaves out the interpreter's startup before site runs
+      "Wall Seconds": resources.get("wall_s"),
+      "CPU Seconds": cpu_seconds,
+      "Max RSS KB": resources.get("maxrss_kb"),
+      "Threads": resources.get("threads"),
+   }
+
+class ModuleColumns:
+   '''Columns of the module rows (one per module of each record) of a batch of log files'''
+   def __init__(self, rules):
+      self.columns = {name: [] for name in COLUMNS}
+      self.rows = 0
+      self._rules = rules
+
+   def add_record(self, log_data):
+      '''Append the rows of a record; returns the number of rows added'''
+      fields = record_columns(log_data)
+      if fields is None:
+         return 0
+      versions = module_versions(log_data)
+      modules = list(versions)
+      count = len(modules)
+      columns = self.columns
+      columns["Module"] += modules
+      columns["Version"] += versions.values()
+      columns["Ignored"] += [self._rules.is_ignored(module) for module in modules]
+      columns["Category"] += [self._rules.category(module) for module in modules]
+      for name, value in fields.items():
+         columns[name] += [value] * count
+      self.rows += count
+      return count
+
+   def to_frame(self):
+      if not self.rows:
+         # empty for login nodes and files without records
+         return pd.DataFrame()
+      return pd.DataFrame({
+         name: pd.Series(values, dtype=COLUMN_DTYPES.get(name, "category"))
+         for name, values in self.columns.items()
+      })
+
+def extract_data_from_log(log_filename, batch):
+   '''Add the rows of a log file to batch (a ModuleColumns); returns the number
+   of rows added, or None if the file could not be read'''
    try:
-     with open(log_filename, "r") as f:
-        try:
-          log_data = json.load(f)
-        except:
-          print("failed to parse the json in file: ",log_filename)
-          return None
-   except:
+     log_records = list(read_records(log_filename))
+   except OSError:
      print("failed to open file: ",log_filename)
      return None
+   except:
+     print("failed to parse the record in file: ",log_filename)
+     return None
    try:
-      rows = []
-      for module, version in log_data["versions"].items():
-         env = log_data["env"]
-         queue_name = "N/A"
-         account = "N/A"
-         nodenum = "N/A"
-         job_name = "N/A"
-         job_dir = "N/A"
-         pals_depth = env.get("PALS_DEPTH","N/A")
-         pals_local_rankid = env.get("PALS_LOCAL_RANKID","N/A")
-         pals_nodeid = env.get("PALS_NODEID","N/A")
-         pals_rankid = env.get("PALS_RANKID","N/A")
-
-         if "PBS_JOBID" in env:
-            job_id = env.get("PBS_JOBID", "N/A")  # Assuming the PBS_JOBID exists, else None is returned
-            queue_name = env.get("PBS_QUEUE", "N/A")
-            account = env.get("PBS_ACCOUNT","N/A")
-            nodenum = env.get("PBS_NODENUM","N/A")
-            job_name = env.get("PBS_JOBNAME","N/A")
-            job_dir = env.get("PBS_JOBDIR","N/A")
-         elif "COBALT_JOBID" in env:
-            job_id = env.get("COBALT_JOBID","N/A")
-            queue_name = env.get("COBALT_QUEUE", "N/A")
-            job_size = env.get("COBALT_PARTSIZE", "N/A")
-            account = env.get("COBALT_ACCOUNT","N/A")
-            job_name = env.get("COBALT_JOBNAME","N/A")
-         elif "login" in log_data["hostname"]:
-            # ignore login node runs
-            return None
-         
-         # PMI variables set by MPICH when running MPI
-         job_size = env.get("PMI_SIZE",env.get("WORLD_SIZE",env.get("NRANKS",env.get("NUMRANKS",1))))
-         job_id = env.get("PMI_JOBID","N/A")
-         pmi_local_rank = env.get("PMI_LOCAL_RANK","N/A")
-         pmi_local_size = env.get("PMI_LOCAL_SIZE","N/A")
-         pmi_rank = env.get("PMI_RANK","N/A")
-         pmi_size = env.get("PMI_SIZE","N/A")
-         # print("job id: ",job_id)
-         data_row = {
-            "Module": module,
-            "Version": version,
-            "User": env.get("USER",env.get('PBS_O_LOGNAME',str(env.get('HOME')).split('/'[-1]))),
-            "Hostname": log_data["hostname"],
-            "Timestamp": log_data["timestamp"],
-            "Python Executable": log_data["sys.executable"],
-            "Ignored": (module in ignore_modules) or module.startswith('_') or ('.' in module),
-            "Job ID": job_id,
-            "Queue": queue_name,
-            "Job Size": job_size,
-            "Account": account,
-            "Node Number": nodenum,
-            "Job Name": job_name,
-            "Job Directory": job_dir,
-            "PALS Depth": pals_depth,
-            "PALS Rank ID": pals_rankid,
-            "PALS Local Rank ID": pals_local_rankid,
-            "PALS Node ID": pals_nodeid,
-            "PMI Local Rank": pmi_local_rank,
-            "PMI Local Size": pmi_local_size,
-            "PMI Rank": pmi_rank,
-            "PMI Size": pmi_size,
-         }
-
-         data_row["Category"] = next((k for k, v in categories.items() if module in v), "none")
-         
-         rows.append(data_row)
-
-      return pd.DataFrame(rows)
+      # spool files flushed by flush_spool.py hold many records
+      return sum(batch.add_record(log_data) for log_data in log_records)
    except:
       print('failed to parse: ',log_filename)
       raise
 
-def parallel_processing(log_files, ignore_modules, categories, n_processes):
+def extract_batch(log_files, rules):
+   '''(one frame of the rows of log_files, the parse status of each file)'''
+   batch = ModuleColumns(rules)
+   statuses = [parse_status(extract_data_from_log(log_filename, batch)) for log_filename in log_files]
+   return batch.to_frame(), statuses
+
+def make_batches(log_files, n_processes):
+   # a few batches per worker keeps them busy to the end on small days
+   batch_size = max(1, min(FILES_PER_BATCH, -(-len(log_files) // (n_processes * 4))))
+   return [log_files[i:i + batch_size] for i in range(0, len(log_files), batch_size)]
+
+def parallel_processing(log_files, rules, n_processes):
+   batches = make_batches(log_files, n_processes)
+   with Pool(n_processes) as p:
+      results = p.starmap(extract_batch, [(batch, rules) for batch in batches])
+   frames = [df for df, _ in results if len(df) > 0]
+   daily_df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+   return daily_df, [status for _, statuses in results for status in statuses]
+
+def write_shard(task):
+   '''Parse a batch and write its rows to a shard file in shard_dir: a headerless
+   gzip CSV, or a Parquet part file. Returns (batch index, shard path or None,
+   {log file: parse status}); the rows never go back to the parent'''
+   index, log_files, rules, shard_dir, output_format = task
+   df, statuses = extract_batch(log_files, rules)
+   shard = None
+   if output_format == FORMAT_PARQUET:
+      shard = write_part(df, shard_dir)
+   elif len(df) > 0:
+      shard = os.path.join(shard_dir, f'{index:06d}.csv.gz')
+      # appending to a new file leaves out the header; the day's file has it
+      write_frame(df, shard, append=True)
+   return index, shard, dict(zip(log_files, statuses))
+
+def streaming_processing(log_files, rules, n_processes, shard_dir, output_format):
+   '''As parallel_processing, but the workers write their rows to shards in
+   shard_dir, so the parent only holds the shard paths: memory stays bounded by
+   the batch size however large the day. Returns (shard paths in batch order,
+   parse statuses)'''
+   batches = make_batches(log_files, n_processes)
+   tasks = [(i, batch, rules, shard_dir, output_format) for i, batch in enumerate(batches)]
+   shards = {}
+   statuses = {}
    with Pool(n_processes) as p:
-      dfs = p.starmap(extract_data_from_log, [(log, ignore_modules, categories) for log in log_files])
-   valid_dfs = [df for df in dfs if df is not None]
-   return pd.concat(valid_dfs, ignore_index=True)
+      for index, shard, batch_statuses in p.imap_unordered(write_shard, tasks):
+         if shard is not None:
+            shards[index] = shard
+         statuses.update(batch_statuses)
+   return [shards[i] for i in sorted(shards)], [statuses[path] for path in log_files]
+
+def merge_shards(shards, output_format, daily_output_path, append):
+   '''Add the shards to the day's output, replacing its rows unless append,
+   without reading them: Parquet shards are moved in as part files, and gzip
+   CSV shards are copied after the header, as gzip members concatenate'''
+   if output_format == FORMAT_PARQUET:
+      if not append and os.path.isdir(daily_output_path):
+         shutil.rmtree(daily_output_path)
+      os.makedirs(daily_output_path, exist_ok=True)
+      for shard in shards:
+         os.replace(shard, os.path.join(daily_output_path, os.path.basename(shard)))
+      return
+   if not append:
+      write_frame(pd.DataFrame(columns=COLUMNS), daily_output_path)
+   with open(daily_output_path, 'ab') as output:
+      for shard in shards:
+         with open(shard, 'rb') as f:
+            shutil.copyfileobj(f, output)
 
 
 if __name__ == "__main__":
@@ -102,48 +220,92 @@ Process JSON log files output by PyModuleSnooper to generate daily CSVs of modul
 Each module is converted to a row and useful information is added to each row like Job ID,
 User name, hostname, etc. 
 
-The script is currently written to process 1 month at a time.
+The script is currently written to process 1 month at a time. Ingested files are
+recorded in a manifest in the output directory, so a rerun only parses new files
+(appending their rows to the day's CSV) and rewrites the days whose files changed.
+With --format parquet the output directory is a Parquet dataset partitioned by day
+instead (needs pyarrow).
 """)
    parser.add_argument("-g", "--glob", help="Glob string to select log files for the month. Example: '/path/2023/07/??/*'", required=True)
    parser.add_argument("-o", "--output", help="Output directory for the compressed CSV files.", required=True)
    parser.add_argument("-n", "--nprocs", type=int, help="Number of parallel processes to use.", default=4)
    parser.add_argument("-i", "--ignore", help="JSON file with list of modules to ignore. Example Contents: ['os','sys',...]", required=True)
-   parser.add_argument("-c", "--category", help="JSON file defining module categories. Example Contents: {'AI':['tensorflow',..],'IO':['pandas','hdf5'],..}", required=True)
+   parser.add_argument("-c", "--category", help="JSON file defining module categories. Example Contents: {'AI':['tensorflow',..],'IO':['pandas','hdf5'],..}. Names cover their submodules and may be glob patterns ('torch_*').", required=True)
    
    parser.add_argument("--overwrite",action="store_true",help="overwrite existing output files.",default=False)
+   parser.add_argument("--manifest", help="SQLite ingestion manifest. [DEFAULT=<output>/manifest.sqlite]", default=None)
+   parser.add_argument("--since", type=datetime.date.fromisoformat, help="Only process days from this date on. Example: 2023-07-15", default=None)
+   parser.add_argument("-f", "--format", choices=FORMATS, help="Output format. [DEFAULT=csv]", default="csv")
+   parser.add_argument("--stream", action="store_true", default=False,
+                       help="Workers write their rows to shard files merged into the day's output, instead of returning them: bounds memory on large days.")
 
    args = parser.parse_args()
+   try:
+      check_format(args.format)
+   except ImportError as e:
+      parser.error(str(e))
 
-   # Load modules to ignore
-   with open(args.ignore, "r") as f:
-      ignore_modules = json.load(f)
-
-   # Load module categories
-   with open(args.category, "r") as f:
-      categories = json.load(f)
+   # Load the modules to ignore and the module categories
+   rules = ModuleRules.from_files(categories=args.category, ignore=args.ignore)
 
 
    # Split path into segments
    path_segments = args.glob.split('/')
    year, month = path_segments[-4], path_segments[-3]
 
-   base_path = args.glob.rsplit('/', 2)[0]  # Extract up to "/2023/07"
-   days = sorted(set([os.path.basename(p) for p in glob.glob(base_path + '/??')]))
+   root = args.glob.rsplit('/', 4)[0]  # Extract up to the directory holding "2023/07"
 
-   for day in days:
-      daily_glob = base_path + f'/{day}/*'
-      daily_log_files = glob.glob(daily_glob)
+   manifest = IngestManifest(args.manifest or os.path.join(args.output, 'manifest.sqlite'))
+   # only the month's day directories from --since on are listed
+   for (_, _, day_number), day_dir in log_day_dirs(root, [int(year)], [int(month)], since=args.since):
+      day = f'{day_number:02d}'
+      daily_log_files = day_log_files(day_dir)
 
       if not daily_log_files:
          print(f"No log files found for {day}. Skipping.")
          continue
 
-      print(f"Processing {len(daily_log_files)} files for {day}...",end='')
-      daily_output_path = os.path.join(args.output, f'modules_{year}_{month}_{day}.csv.gz')
-      if os.path.exists(daily_output_path) and not args.overwrite:
-         print(" skipped.")
+      if args.format == FORMAT_PARQUET:
+         daily_output_path = partition_dir(args.output, year, month, day)
+         partition = os.path.relpath(daily_output_path, args.output)
+         # there are no Parquet days from before the manifest; an empty day has no files
+         output_exists = partition_exists(daily_output_path) or manifest.has_partition(partition)
+      else:
+         daily_output_path = os.path.join(args.output, f'modules_{year}_{month}_{day}.csv.gz')
+         partition = os.path.basename(daily_output_path)
+         output_exists = os.path.exists(daily_output_path)
+      if output_exists and not args.overwrite and not manifest.has_partition(partition):
+         print(f"{partition} was written without the manifest; use --overwrite to rebuild it. Skipping.")
+         continue
+
+      entries = stat_files(daily_log_files)
+      new, changed = manifest.changes(entries)
+      # rows of changed files are already in the day's CSV: rebuild it
+      rewrite = args.overwrite or changed or not output_exists
+      to_parse = entries if rewrite else new
+      if not to_parse:
+         print(f"{day}: up to date.")
          continue
 
-      daily_df = parallel_processing(daily_log_files, ignore_modules, categories, args.nprocs)
-      daily_df.to_csv(daily_output_path, index=False, compression='gzip')
+      print(f"Processing {len(to_parse)} of {len(entries)} files for {day}...",end='')
+      log_files = [path for path, _, _ in to_parse]
+      if args.stream:
+         # next to the output, so Parquet shards are moved in without a copy
+         shard_dir = tempfile.mkdtemp(prefix='.shards-', dir=args.output)
+         shards, statuses = streaming_processing(log_files, rules, args.nprocs, shard_dir, args.format)
+         if rewrite:
+            manifest.forget_partition(partition)
+         merge_shards(shards, args.format, daily_output_path, append=not rewrite)
+         shutil.rmtree(shard_dir)
+      else:
+         daily_df, statuses = parallel_processing(log_files, rules, args.nprocs)
+         if rewrite:
+            manifest.forget_partition(partition)
+         if args.format == FORMAT_PARQUET:
+            write_partition(daily_df, args.output, year, month, day, append=not rewrite)
+         elif rewrite or len(daily_df) > 0:
+            write_frame(daily_df, daily_output_path, append=not rewrite)
+      manifest.record([entry + (status,) for entry, status in zip(to_parse, statuses)], partition)
       print(" done processing.")
+   print("Ingested files by parse status:", manifest.status_counts())
+   manifest.close()
@@ -0,0 +1,49 @@
+import argparse
+import glob
+from collections import defaultdict
+from snooper_records import expand_log_paths, read_records
+
+def import_subtree_times(record):
+   '''{module: microseconds to find and execute it, including the imports it triggered}'''
+   times = record.get('import_times')
+   if not times:
+      return {}
+   return {
+      module: find_us + exec_us
+      for module, find_us, exec_us in zip(times['modules'], times['find_us'], times['exec_us'])
+   }
+
+def rank_import_times(log_files):
+   '''{environment: {module: [total microseconds, number of processes]}}, by sys.executable'''
+   totals = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+   for log_filename in log_files:
+      try:
+         records = list(read_records(log_filename))
+      except:
+         print("failed to parse the record in file: ",log_filename)
+         continue
+      for record in records:
+         env_totals = totals[record['sys.executable']]
+         for module, subtree_us in import_subtree_times(record).items():
+            env_totals[module][0] += subtree_us
+            env_totals[module][1] += 1
+   return totals
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="""
+Rank the most expensive import subtrees per Python environment, from logs written
+with PYMODULE_LOG_IMPORT_TIMES=1. A module's subtree time is the time to find it
+plus its execution time, which includes every import it triggered.
+""")
+   parser.add_argument("-g", "--glob", help="Glob string to select log files. Example: '/path/2023/07/??/*'", required=True)
+   parser.add_argument("-t", "--top", type=int, help="Number of modules to report per environment.", default=20)
+   args = parser.parse_args()
+
+   totals = rank_import_times(expand_log_paths(glob.glob(args.glob)))
+   for environment, env_totals in sorted(totals.items()):
+      print(f"{environment}:")
+      print(f"   {'total s':>10} {'mean ms':>10} {'count':>8}  module")
+      ranked = sorted(env_totals.items(), key=lambda item: item[1][0], reverse=True)
+      for module, (total_us, count) in ranked[:args.top]:
+         print(f"   {total_us / 1e6:10.2f} {total_us / count / 1e3:10.2f} {count:8d}  {module}")
@@ -0,0 +1,32 @@
+import argparse
+import json
+import sys
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="""
+Answer like `qstat -fx -F json <job ids>` from a saved qstat JSON output, for
+running parse_modfiles_to_jobfiles.py away from PBS:
+   parse_modfiles_to_jobfiles.py --qstat "python replay_qstat.py jobs.json" ...
+Jobs can be asked for by their full id or their number.
+""")
+   parser.add_argument("jobs", help="JSON file of qstat -F json output: {'Jobs': {job id: details}}.")
+   parser.add_argument("job_ids", nargs="*", help="Job ids to print.")
+   args = parser.parse_args()
+
+   with open(args.jobs) as f:
+      jobs = json.load(f)['Jobs']
+   by_number = {job_id.split('.')[0]: job_id for job_id in jobs}
+
+   found = {}
+   unknown = False
+   for job_id in args.job_ids:
+      key = job_id if job_id in jobs else by_number.get(job_id.split('.')[0])
+      if key is None:
+         print(f"qstat: Unknown Job Id {job_id}", file=sys.stderr)
+         unknown = True
+      else:
+         found[key] = jobs[key]
+   if found:
+      json.dump({'Jobs': found}, sys.stdout, indent=4)
+      print()
+   sys.exit(35 if unknown else 0)
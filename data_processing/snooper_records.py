@@ -0,0 +1,524 @@
+'''Shared helpers for reading PyModuleSnooper log records.
+
+Records written by `sitecustomize.py` may carry large fields (env, sys.path)
+as hashes into the per-day `.blobs` store next to the log files. The helpers
+here return records with those fields resolved, so callers can keep using
+`record['env']` as before. Module paths, written as (prefix index, relative
+path) pairs against the record's `path_prefixes` table, are expanded back to
+full paths as well.
+
+Log files hold either JSON lines or, when written with
+PYMODULE_LOG_FORMAT=binary, length-prefixed zlib-compressed records; both are
+read through `read_records`/`load_record`.
+
+With PYMODULE_LOG_SHARDS set, a day's files are spread over hashed
+sub-directories (YYYY/MM/DD/hXX/); `day_log_files` lists the files of a day in
+either layout, and the day's blob store is found from files in both.
+`log_tree_files` crawls a whole log tree, only entering the days asked for.
+
+Scripts that only need some fields pass a field spec to `read_records`; the
+other fields (most of all the large 'env') are skipped instead of decoded, see
+`extract_fields`.
+
+Processes logging periodic snapshots (PYMODULE_LOG_SNAPSHOTS) write a full
+record followed by deltas; `read_records` merges each series into one record.
+
+The node-side tools (collector.py, flush_spool.py) also use the writer
+helpers at the end of this module.
+'''
+import functools
+import hashlib
+import json
+from json.decoder import scanstring
+import os
+import re
+import struct
+import zlib
+
+BLOB_DIRNAME = '.blobs'
+SHARD_PREFIX = 'h'
+# Field specs map a top-level field to None (decode it), KEYS_ONLY (an object
+# read with its keys only, values as None) or a list of the keys of an object to
+# decode. Fields needed to complete records are always decoded
+KEYS_ONLY = 'keys-only'
+STRUCTURAL_FIELDS = ('blobs', 'path_prefixes', 'snapshot', 'hostname', 'pid', 'timestamp')
+BLOB_FIELDS = ('env', 'sys.path')
+RECORD_BLOB = 'record'
+BINARY_MAGIC = b'\x89PMS'
+BINARY_VERSION = 1
+BINARY_VERSIONS = (1,)
+BINARY_HEADER = struct.Struct('>4sBI')
+
+
+@functools.lru_cache(maxsize=256)
+def load_blob(blob_path):
+   '''The value stored in blob_path; ValueError if it is not the one its name
+   hashes (the store is writable by every user)'''
+   with open(blob_path, 'rb') as f:
+      blob = f.read()
+   if hashlib.sha1(blob).hexdigest() != os.path.basename(blob_path):
+      raise ValueError('blob does not match its hash: %s' % blob_path)
+   return json.loads(blob)
+
+
+def is_shard_dir(name):
+   '''True for the hashed sub-directories (hXX) of a day directory'''
+   digits = name[len(SHARD_PREFIX):]
+   return name.startswith(SHARD_PREFIX) and bool(digits) and all(c in '0123456789abcdef' for c in digits)
+
+
+def log_day_dir(log_filename):
+   '''The YYYY/MM/DD directory holding log_filename, directly or in a shard'''
+   log_dir = os.path.dirname(os.path.abspath(log_filename))
+   if is_shard_dir(os.path.basename(log_dir)):
+      return os.path.dirname(log_dir)
+   return log_dir
+
+
+def _day_file_entries(day_dir):
+   '''Yield the os.DirEntry of each log file of a YYYY/MM/DD directory, flat or sharded'''
+   with os.scandir(day_dir) as entries:
+      for entry in entries:
+         if entry.name.startswith('.'):
+            continue
+         if not entry.is_dir():
+            yield entry
+         elif is_shard_dir(entry.name):
+            with os.scandir(entry.path) as shard_entries:
+               yield from (e for e in shard_entries if not e.name.startswith('.') and not e.is_dir())
+
+
+def day_log_files(day_dir):
+   '''Paths of the log files of a YYYY/MM/DD directory, flat or sharded'''
+   return [entry.path for entry in _day_file_entries(day_dir)]
+
+
+def _numbered_dirs(path, width, selected):
+   '''Sorted (number, path) of the sub-directories of path named by a number of
+   width digits, only the numbers in selected if it is not empty'''
+   try:
+      with os.scandir(path) as entries:
+         dirs = [(int(e.name), e.path) for e in entries
+                 if len(e.name) == width and e.name.isdigit() and e.is_dir()]
+   except FileNotFoundError:
+      return []
+   return sorted((number, dir_path) for number, dir_path in dirs if not selected or number in selected)
+
+
+def _as_date_key(date):
+   return date and (date.year, date.month, date.day)
+
+
+def log_day_dirs(root, years=(), months=(), days=(), since=None, until=None):
+   '''Yield ((year, month, day), path) of the YYYY/MM/DD directories of the log
+   tree at root, in date order.
+
+   Only the selected years, months and days (all if empty) from since to until
+   (datetime.date, both included) are yielded, and only the directories that
+   can hold them are listed: a year or month outside the selection is skipped
+   without being read.
+   '''
+   since, until = _as_date_key(since), _as_date_key(until)
+
+   def in_range(key):
+      return not (since and key < since[:len(key)]) and not (until and key > until[:len(key)])
+
+   for year, year_dir in _numbered_dirs(root, 4, years):
+      if not in_range((year,)):
+         continue
+      for month, month_dir in _numbered_dirs(year_dir, 2, months):
+         if not in_range((year, month)):
+            continue
+         for day, day_dir in _numbered_dirs(month_dir, 2, days):
+            if in_range((year, month, day)):
+               yield (year, month, day), day_dir
+
+
+def log_tree_files(root, years=(), months=(), days=(), since=None, until=None):
+   '''Yield (path, size, mtime_ns) of the non-empty log files of the days
+   log_day_dirs selects, as the day directories are read.
+
+   Sizes come from the directory entries (free on Windows, one stat on POSIX),
+   so callers need not stat the files again; the tuples are the entries of the
+   ingestion manifest.
+   '''
+   for _, day_dir in log_day_dirs(root, years, months, days, since, until):
+      for entry in _day_file_entries(day_dir):
+         try:
+            st = entry.stat()
+         except OSError:
+            # removed since the directory was read
+            continue
+         if st.st_size:
+            yield entry.path, st.st_size, st.st_mtime_ns
+
+
+def expand_log_paths(paths):
+   '''Yield paths (e.g. a glob's matches), with shard directories replaced by their files'''
+   for path in paths:
+      if not os.path.isdir(path):
+         yield path
+      elif is_shard_dir(os.path.basename(path)):
+         with os.scandir(path) as entries:
+            yield from (e.path for e in entries if not e.name.startswith('.') and not e.is_dir())
+
+
+def resolve_blobs(record, log_filename, select=None):
+   '''Replace hashed fields in record with their values from the blob store,
+   only those chosen by select (from compile_fields) if it is set.
+
+   A reference record (a process identical to one already logged that day on
+   the same node) keeps its own timestamp, pid, argv, env and mpi and takes
+   every other field from the shared 'record' blob.
+   '''
+   blobs = record.pop('blobs', None)
+   if not blobs:
+      return record
+   blob_dir = os.path.join(log_day_dir(log_filename), BLOB_DIRNAME)
+   if RECORD_BLOB in blobs:
+      blobs = dict(blobs)
+      fingerprint = blobs.pop(RECORD_BLOB)
+      # the hash of the shared fields stands for the process' fingerprint
+      shared = load_blob(os.path.join(blob_dir, fingerprint))
+      for field, value in shared.items():
+         if field == 'blobs':
+            # the record's own blobs (its env) come first
+            for blob_field, digest in value.items():
+               blobs.setdefault(blob_field, digest)
+         else:
+            record.setdefault(field, value)
+      record['fingerprint'] = fingerprint
+   for field, digest in blobs.items():
+      if select is None:
+         record[field] = load_blob(os.path.join(blob_dir, digest))
+      elif field in select:
+         record[field] = select_fields(load_blob(os.path.join(blob_dir, digest)), select[field])
+   return record
+
+
+def expand_module_paths(record):
+   '''Turn [prefix index, relative path] module entries back into full paths'''
+   prefixes = record.pop('path_prefixes', None)
+   if prefixes is None:
+      return record
+   record['modules'] = {
+      module: prefixes[path[0]] + path[1] if isinstance(path, list) else path
+      for module, path in record['modules'].items()
+   }
+   return record
+
+
+def module_versions(record):
+   '''{module: version} for every module in record.
+
+   Newer records carry versions per distribution, keyed by top-level module
+   (with a 'distributions' field); submodules get their package's version
+   and modules outside any distribution get 'None', as older records had.
+   '''
+   if 'distributions' not in record:
+      return record['versions']
+   versions = record['versions']
+   return {
+      module: versions.get(module.split('.')[0], 'None')
+      for module in record['modules']
+   }
+
+
+# above this many selected keys, decoding a whole flat object beats one
+# str.find through it per key
+FIND_KEYS_MAX = 4
+_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def _escaped_quotes(text, start, end):
+   '''Number of quotes in text[start:end] escaped by an odd run of backslashes.
+
+   A quote after a run of r backslashes is counted once by the counts of
+   '\\'*k + '"' for every k <= r; alternating their signs leaves 1 for odd r.
+   '''
+   escaped, sign, k = 0, 1, 1
+   count = text.count('\\"', start, end)
+   while count:
+      escaped += sign * count
+      sign, k = -sign, k + 1
+      count = text.count('\\' * k + '"', start, end)
+   return escaped
+
+
+def _flat_object_end(text, pos):
+   '''Index just past the object at text[pos] if it holds no nested objects or
+   arrays, else -1.
+
+   Found with str.find/str.count rather than by decoding: a '}' closes the
+   object when an even number of unescaped quotes precede it, and a bracket
+   inside it only opens a nested value when a key's ':' precedes it.
+   '''
+   quotes = 0
+   start = pos
+   end = text.find('}', pos)
+   while end >= 0:
+      quotes += text.count('"', start, end)
+      if text.find('\\', start, end) >= 0:
+         quotes -= _escaped_quotes(text, start, end)
+      if quotes % 2 == 0:
+         break
+      start, end = end, text.find('}', end + 1)
+   else:
+      return -1
+   for bracket in '{[':
+      found = text.find(bracket, pos + 1, end)
+      while found >= 0:
+         before = found - 1
+         while text[before] in ' \t\n\r':
+            before -= 1
+         if text[before] == ':':
+            return -1
+         found = text.find(bracket, found + 1, end)
+   return end + 1
+
+
+def _plain_keys(select):
+   '''True if every key of select is written as itself between quotes, so str.find can find it'''
+   return all(json.dumps(key)[1:-1] == key for key in select)
+
+
+def _find_keys(text, pos, end, select):
+   '''The selected keys of the flat object at text[pos:end], each located with str.find.
+
+   Quotes inside strings are escaped, so an unescaped quote after '{' or ','
+   opens a key.
+   '''
+   result = {}
+   for key, spec in select.items():
+      token = json.dumps(key)
+      found = text.find(token, pos, end)
+      while found >= 0:
+         before = found - 1
+         while text[before] in ' \t\n\r':
+            before -= 1
+         after = _WHITESPACE.match(text, found + len(token)).end()
+         if text[before] in '{,' and text[after] == ':':
+            value = _DECODER.raw_decode(text, _WHITESPACE.match(text, after + 1).end())[0]
+            result[key] = select_fields(value, spec)
+            break
+         found = text.find(token, found + 1, end)
+   return result
+
+
+def _skip_value(text, pos):
+   '''Index just past the JSON value at text[pos], without building flat objects'''
+   if text[pos] == '{':
+      end = _flat_object_end(text, pos)
+      if end >= 0:
+         return end
+   return _DECODER.raw_decode(text, pos)[1]
+
+
+def _decode_object(text, pos, select):
+   '''(the selected part of the JSON object at text[pos], index past it)'''
+   if text[pos] != '{':
+      raise ValueError('expected an object at %d' % pos)
+   result = {}
+   pos = _WHITESPACE.match(text, pos + 1).end()
+   if text[pos] == '}':
+      return result, pos + 1
+   while True:
+      if text[pos] != '"':
+         raise ValueError('expected a key at %d' % pos)
+      key, pos = scanstring(text, pos + 1)
+      pos = _WHITESPACE.match(text, pos).end()
+      if text[pos] != ':':
+         raise ValueError('expected ":" at %d' % pos)
+      pos = _WHITESPACE.match(text, pos + 1).end()
+      if key not in select:
+         pos = _skip_value(text, pos)
+      else:
+         spec = select[key]
+         end = -1
+         if isinstance(spec, dict) and len(spec) <= FIND_KEYS_MAX and text[pos] == '{' and _plain_keys(spec):
+            end = _flat_object_end(text, pos)
+         if end >= 0:
+            result[key], pos = _find_keys(text, pos, end, spec), end
+         else:
+            value, pos = _DECODER.raw_decode(text, pos)
+            result[key] = select_fields(value, spec)
+      pos = _WHITESPACE.match(text, pos).end()
+      if text[pos] == ',':
+         pos = _WHITESPACE.match(text, pos + 1).end()
+      elif text[pos] == '}':
+         return result, pos + 1
+      else:
+         raise ValueError('expected "," or "}" at %d' % pos)
+
+
+def select_fields(value, select):
+   '''The selected part of an already decoded value (all of it if select is None)'''
+   if select is None or not isinstance(value, dict):
+      return value
+   if select is KEYS_ONLY:
+      return dict.fromkeys(value)
+   return {
+      key: select_fields(item, select[key])
+      for key, item in value.items() if key in select
+   }
+
+
+def compile_fields(fields):
+   '''The select tree of a field spec, with the structural fields added'''
+   select = dict.fromkeys(STRUCTURAL_FIELDS)
+   for field, spec in fields.items():
+      select[field] = dict.fromkeys(spec) if isinstance(spec, (list, tuple)) else spec
+   return select
+
+
+def extract_fields(text, select):
+   '''Decode the fields chosen by select (from compile_fields) of the JSON record in text.
+
+   Top-level keys are scanned with the json module's C scanner. Flat objects
+   (such as 'env') are skipped, or searched for their selected keys, with
+   str.find instead of being decoded; every other value is decoded with
+   raw_decode, which is faster than any scan in Python. Anything unexpected
+   falls back to a full parse.
+   '''
+   if isinstance(text, bytes):
+      text = text.decode('utf-8')
+   try:
+      record, end = _decode_object(text, _WHITESPACE.match(text).end(), select)
+      if text[end:].strip():
+         raise ValueError('extra data at %d' % end)
+      return record
+   except (ValueError, IndexError):
+      return select_fields(json.loads(text), select)
+
+
+def decode_binary_records(data, select=None):
+   '''Yield the records packed in data by sitecustomize.encode_binary_record'''
+   offset = 0
+   while offset < len(data):
+      if len(data) - offset < BINARY_HEADER.size:
+         raise ValueError('truncated record header at offset %d' % offset)
+      magic, version, length = BINARY_HEADER.unpack_from(data, offset)
+      if magic != BINARY_MAGIC or version not in BINARY_VERSIONS:
+         raise ValueError('bad record header at offset %d' % offset)
+      offset += BINARY_HEADER.size
+      if len(data) - offset < length:
+         raise ValueError('truncated record at offset %d' % offset)
+      payload = zlib.decompress(data[offset:offset + length])
+      yield json.loads(payload) if select is None else extract_fields(payload, select)
+      offset += length
+
+
+def complete_binary_length(data):
+   '''Length of the prefix of data made of whole binary records.
+
+   A writer killed in the middle of an append leaves a truncated record at
+   the end of a spool file; everything before it is still usable.
+   '''
+   offset = 0
+   while len(data) - offset >= BINARY_HEADER.size:
+      magic, version, length = BINARY_HEADER.unpack_from(data, offset)
+      if magic != BINARY_MAGIC or version not in BINARY_VERSIONS:
+         break
+      if len(data) - offset - BINARY_HEADER.size < length:
+         break
+      offset += BINARY_HEADER.size + length
+   return offset
+
+
+def decode_records(data, select=None):
+   '''Yield the records in data, the raw content of a log file: binary records,
+   JSON lines or one pretty-printed JSON record (as example_log_output.json)'''
+   if data.startswith(BINARY_MAGIC):
+      yield from decode_binary_records(data, select)
+      return
+   lines = (line for line in data.splitlines() if line.strip())
+   first = next(lines, None)
+   if first is None:
+      return
+   try:
+      record = json.loads(first) if select is None else extract_fields(first, select)
+   except ValueError:
+      # not one record per line; the whole file is one record
+      record = json.loads(data)
+      yield record if select is None else select_fields(record, select)
+      return
+   yield record
+   for line in lines:
+      yield json.loads(line) if select is None else extract_fields(line, select)
+
+
+def merge_snapshots(records):
+   '''Merge the snapshot records of each process into one record, yielded when
+   its series is closed or at the end of records; other records pass through'''
+   series = {}
+   for record in records:
+      snapshot = record.get('snapshot')
+      if snapshot is None:
+         yield record
+         continue
+      key = (record['hostname'], record['pid'], snapshot['series'])
+      merged = series.get(key)
+      if merged is None:
+         series[key] = merged = record
+      else:
+         merged['modules'].update(record['modules'])
+         for field in ('versions', 'distributions'):
+            merged.setdefault(field, {}).update(record.get(field, {}))
+         # the latest snapshot stands for the whole series
+         for field in ('timestamp', 'snapshot', 'resources', 'mpi', 'import_times'):
+            if field in record:
+               merged[field] = record[field]
+      if snapshot['final']:
+         yield series.pop(key)
+   yield from series.values()
+
+
+def read_records(log_filename, fields=None):
+   '''Yield every record stored in log_filename, with only the given fields (a
+   field spec, see KEYS_ONLY) of inline values decoded if fields is set'''
+   with open(log_filename, 'rb') as f:
+      data = f.read()
+   select = None if fields is None else compile_fields(fields)
+   yield from merge_snapshots(
+      expand_module_paths(resolve_blobs(record, log_filename, select)) for record in decode_records(data, select)
+   )
+
+
+def load_record(log_filename):
+   '''Load the (first) record stored in log_filename'''
+   for record in read_records(log_filename):
+      return record
+   raise ValueError('no record in %s' % log_filename)
+
+
+def encode_binary_record(record, level=1):
+   payload = zlib.compress(json.dumps(record).encode(), level)
+   return BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(payload)) + payload
+
+
+def store_blob(blob_dir, value):
+   '''Write value to the blob store once; return its hash'''
+   blob = json.dumps(value, sort_keys=True).encode()
+   digest = hashlib.sha1(blob).hexdigest()
+   blob_path = os.path.join(blob_dir, digest)
+   if not os.path.exists(blob_path):
+      if not os.path.isdir(blob_dir):
+         os.makedirs(blob_dir, exist_ok=True)
+         os.chmod(blob_dir, 0o3777)
+      tmp_path = os.path.join(blob_dir, '.{}.{}'.format(digest, os.getpid()))
+      with open(tmp_path, 'wb') as f:
+         f.write(blob)
+      os.rename(tmp_path, blob_path)
+   return digest
+
+
+def dedup_blobs(record, blob_dir):
+   '''Move the inline BLOB_FIELDS of record to the blob store, as sitecustomize does'''
+   blobs = record.setdefault('blobs', {})
+   for field in BLOB_FIELDS:
+      if field in record:
+         blobs[field] = store_blob(blob_dir, record.pop(field))
+   if not blobs:
+      del record['blobs']
+   return record
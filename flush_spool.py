@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+'''Move node-local spooled PyModuleSnooper records to the shared log tree.
+
+With PYMODULE_LOG_SPOOL set, sitecustomize.py appends binary records to
+SPOOL/YYYY/MM/DD/<hostname>.<uid>.spool. Run this periodically (cron) and/or
+from the job epilogue, as root, to append each day's spooled records to one
+file per node per day, LOGROOT/YYYY/MM/DD/<hostname>.spool, and to copy the
+day's env/sys.path blobs to LOGROOT/YYYY/MM/DD/.blobs.
+
+A spool file is claimed by renaming it to *.flushing before it is read, and a
+*.commit note records the offset its records are appended at, so a flush
+interrupted at any point is completed (without duplicating records) by the
+next run. Only notes this flusher wrote (owned by its uid) are used, and the
+file a batch goes to is always derived from the spool's day and hostname,
+never read from a note: spool directories are writable by users.
+
+Records that could not be written to the log tree go to a private spool per
+user, /tmp/pymodulesnooper-spool-<uid>; pass those directories too. As they
+belong to the users, only regular files are read from spools, never through
+a symlink, and a user's spool is appended to a file of that user,
+LOGROOT/YYYY/MM/DD/<hostname>.<uid>.spool, so whatever the user plants in it
+can only affect the user's own records.
+'''
+import argparse
+from datetime import datetime
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import shutil
+import stat
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_processing'))
+from snooper_records import BLOB_DIRNAME, complete_binary_length
+
+CLAIMED_SUFFIX = '.flushing'
+COMMIT_SUFFIX = '.commit'
+LOCK_NAME = '.flush.lock'
+
+
+def open_regular(path, flags=os.O_RDONLY, mode=0o644):
+    '''os.open(path) that neither follows a symlink nor opens anything but a
+    regular file (a FIFO would block), raising OSError otherwise'''
+    fd = os.open(path, flags | os.O_NOFOLLOW | os.O_NONBLOCK, mode)
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        os.close(fd)
+        raise OSError('not a regular file: {}'.format(path))
+    return fd
+
+
+def is_regular(path):
+    return stat.S_ISREG(os.lstat(path).st_mode)
+
+
+def shared_log_path(claimed_path, day_dir, spool_root, log_root, owner=None):
+    '''LOGROOT/YYYY/MM/DD/<hostname>.spool for SPOOL/YYYY/MM/DD/<hostname>.<uid>.spool.flushing,
+    or <hostname>.<owner>.spool for the spool of one user'''
+    hostname = os.path.basename(claimed_path).rsplit('.', 3)[0]
+    name = hostname + '.spool' if owner is None else '{}.{}.spool'.format(hostname, owner)
+    return os.path.join(log_root, os.path.relpath(day_dir, spool_root), name)
+
+
+def copy_blobs(day_dir, log_day_dir):
+    '''Copy blobs missing from the shared store, so records never reference
+    absent blobs; a blob whose content does not hash to its name is left out'''
+    src_dir = os.path.join(day_dir, BLOB_DIRNAME)
+    if not os.path.isdir(src_dir):
+        return
+    dest_dir = os.path.join(log_day_dir, BLOB_DIRNAME)
+    if not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir, exist_ok=True)
+        os.chmod(dest_dir, 0o3777)
+    for digest in os.listdir(src_dir):
+        dest_path = os.path.join(dest_dir, digest)
+        src_path = os.path.join(src_dir, digest)
+        if digest.startswith('.') or os.path.exists(dest_path) or not is_regular(src_path):
+            continue
+        with os.fdopen(open_regular(src_path), 'rb') as src:
+            blob = src.read()
+        if hashlib.sha1(blob).hexdigest() != digest:
+            continue
+        tmp_path = os.path.join(dest_dir, '.{}.{}'.format(digest, os.getpid()))
+        # a new file: a name planted in the shared store fails instead of being followed
+        tmp_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o644)
+        with os.fdopen(tmp_fd, 'wb') as dest:
+            dest.write(blob)
+        os.rename(tmp_path, dest_path)
+
+
+def read_batch(claimed_path):
+    '''Whole records of claimed_path, once writers that opened it before the rename are done'''
+    with os.fdopen(open_regular(claimed_path), 'rb') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        data = f.read()
+    return data[:complete_binary_length(data)]
+
+
+def append_batch(claimed_path, dest_path, data):
+    '''Append data read from claimed_path to dest_path, then drop the claim'''
+    commit_path = claimed_path + COMMIT_SUFFIX
+    with os.fdopen(open_regular(dest_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT), 'ab') as dest:
+        offset = os.fstat(dest.fileno()).st_size
+        with os.fdopen(os.open(commit_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600), 'w') as f:
+            json.dump({'offset': offset, 'length': len(data)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        dest.write(data)
+        dest.flush()
+        os.fsync(dest.fileno())
+    os.unlink(claimed_path)
+    os.unlink(commit_path)
+
+
+def read_commit(commit_path):
+    '''(offset, length) of a commit note written by this flusher, or None for
+    anything else found under its name'''
+    with os.fdopen(open_regular(commit_path)) as f:
+        st = os.fstat(f.fileno())
+        if st.st_uid != os.getuid() or st.st_nlink != 1:
+            return None
+        try:
+            commit = json.load(f)
+            offset, length = commit['offset'], commit['length']
+        except (ValueError, KeyError, TypeError):
+            return None
+    if not all(isinstance(n, int) and n >= 0 for n in (offset, length)):
+        return None
+    return offset, length
+
+
+def recover_batch(claimed_path, dest_path):
+    '''Finish a flush interrupted after claimed_path was claimed, its records
+    going to dest_path.
+
+    Returns True if the batch is fully accounted for, False if it still needs
+    to be appended.
+    '''
+    commit_path = claimed_path + COMMIT_SUFFIX
+    if not os.path.lexists(commit_path):
+        return False
+    try:
+        commit = read_commit(commit_path)
+    except OSError:
+        commit = None
+    if commit is None:
+        # not a note of this flusher: the batch is appended as if never flushed
+        os.unlink(commit_path)
+        return False
+    offset, length = commit
+    if not os.path.lexists(dest_path):
+        os.unlink(commit_path)
+        return False
+    with os.fdopen(open_regular(dest_path, os.O_WRONLY), 'wb') as dest:
+        size = os.fstat(dest.fileno()).st_size
+        if size >= offset + length:
+            os.unlink(claimed_path)
+            os.unlink(commit_path)
+            return True
+        if offset < size:
+            # drop the partial append before doing it again
+            os.ftruncate(dest.fileno(), offset)
+    os.unlink(commit_path)
+    return False
+
+
+def flush_day(day_dir, spool_root, log_root, owner=None):
+    '''Flush the spool files of day_dir; owner is the uid of a user's own spool'''
+    log_day_dir = os.path.join(log_root, os.path.relpath(day_dir, spool_root))
+    os.makedirs(log_day_dir, exist_ok=True)
+
+    def dest(claimed_path):
+        return shared_log_path(claimed_path, day_dir, spool_root, log_root, owner)
+
+    def flush(claimed_paths):
+        batches = [(path, read_batch(path)) for path in claimed_paths]
+        # writers store blobs before appending records, so copy them after reading
+        copy_blobs(day_dir, log_day_dir)
+        for claimed_path, data in batches:
+            append_batch(claimed_path, dest(claimed_path), data)
+        return len(batches)
+
+    # finish batches left by an interrupted flush before claiming the same names again
+    leftover = sorted(
+        path for path in glob.glob(os.path.join(day_dir, '*' + CLAIMED_SUFFIX)) if is_regular(path)
+    )
+    count = flush([path for path in leftover if not recover_batch(path, dest(path))])
+
+    claimed = []
+    for spool_path in sorted(glob.glob(os.path.join(day_dir, '*.spool'))):
+        if not is_regular(spool_path):
+            continue
+        os.rename(spool_path, spool_path + CLAIMED_SUFFIX)
+        claimed.append(spool_path + CLAIMED_SUFFIX)
+    return count + flush(claimed)
+
+
+def flush_spool(spool_root, log_root, today=None):
+    '''Flush every spooled day; remove the spool of days before today once flushed'''
+    today = today or datetime.now().strftime(os.path.join('%Y', '%m', '%d'))
+    # the spool of one user (a fallback spool) goes to files of that user
+    owner = os.lstat(spool_root).st_uid
+    owner = None if owner == os.getuid() else owner
+    lock_fd = os.open(os.path.join(spool_root, LOCK_NAME), os.O_WRONLY | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+    with os.fdopen(lock_fd, 'w') as lock:
+        # one flusher per node at a time (cron and epilogue may overlap)
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        real_root = os.path.realpath(spool_root)
+        for day_dir in sorted(glob.glob(os.path.join(spool_root, '[0-9]' * 4, '[0-9]' * 2, '[0-9]' * 2))):
+            # a day reached through a symlink could be anywhere
+            if os.path.realpath(day_dir) != os.path.join(real_root, os.path.relpath(day_dir, spool_root)):
+                continue
+            count = flush_day(day_dir, spool_root, log_root, owner)
+            print('{}: flushed {} spool files'.format(day_dir, count))
+            if os.path.relpath(day_dir, spool_root) < today:
+                shutil.rmtree(day_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Flush node-local PyModuleSnooper spool files to the shared log directory."
+    )
+    parser.add_argument('spool_roots', nargs='+', metavar='spool_root',
+                        help="Node-local spool directories (PYMODULE_LOG_SPOOL, /tmp/pymodulesnooper-spool-*)")
+    parser.add_argument('log_root', help="Shared log directory (LOGFILE_ROOT in sitecustomize.py)")
+    args = parser.parse_args()
+
+    for spool_root in args.spool_roots:
+        if not os.path.isdir(spool_root) or os.path.islink(spool_root):
+            continue
+        try:
+            flush_spool(spool_root, args.log_root)
+        except OSError as e:
+            # one user's spool must not stop the others being flushed
+            print('{}: not flushed: {}'.format(spool_root, e))
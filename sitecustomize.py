@@ -17,112 +17,1198 @@ because users may register their own handlers.
 * Refer to https://docs.python.org/3.6/library/atexit.html
 '''
 
+# Every interpreter on the system imports this module (including tiny `python -c`
+# helpers), so only atexit/os/sys are imported at startup; everything else is
+# imported inside the functions that run at shutdown
 import atexit
-from datetime import datetime
-import json
-import logging
 import os
-import socket
 import sys
-import re
+
+
+def env_number(name, default, convert=int):
+    '''The number in environment variable name, or default if it is unset or
+    not a number: a bad value must not break every interpreter'''
+    try:
+        return convert(os.environ[name])
+    except (KeyError, ValueError):
+        return default
+
 
 DATETIME_FMT = '%m-%d-%Y %H:%M:%S.%f'
+# Process times when the hook is imported, early in interpreter startup; records
+# carry a resource summary relative to it
+START_TIMES = os.times()
 # April 2024 update to Sirius and Polaris: move logging directory from /lus/swift/soft/...
 # (no longer writable from Polaris) to Eagle. Note, Sirius does not mount Eagle
 LOGFILE_ROOT = os.path.join('/lus', 'eagle', 'logs', 'pythonlogging', 'module_usage')
+# Large, highly repetitive fields are written once per day into a content-addressed
+# store (LOGROOT/year/month/day/.blobs/<sha1>) and records only carry the hash
+BLOB_DIRNAME = '.blobs'
+# Set PYMODULE_LOG_SHARDS to N to spread a day's files over N sub-directories,
+# LOGROOT/year/month/day/h<crc32(hostname) % N, hex>/, created on first use; the
+# blob store stays at the day level
+SHARDS = env_number('PYMODULE_LOG_SHARDS', 0)
+SHARD_PREFIX = 'h'
+BLOB_FIELDS = ('env', 'sys.path')
+# Environment variables kept in records are configured in ENV_FILTER_FILE (next to
+# this module, or PYMODULE_LOG_ENV_FILTER): glob patterns {"allow": [...], "deny": [...]}
+# and "max_value_length". A variable is kept if it matches an allow pattern (any,
+# when allow is empty) and no deny pattern. Without the file env is kept whole
+ENV_FILTER_FILE = os.environ.get(
+    'PYMODULE_LOG_ENV_FILTER',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sitecustomize_env.json'),
+)
+# Set PYMODULE_LOG_FORMAT=binary to write compact records instead of a JSON line:
+# MAGIC, version byte, big-endian uint32 payload length, zlib-compressed JSON payload
+RECORD_FORMAT = os.environ.get('PYMODULE_LOG_FORMAT', 'json')
+BINARY_MAGIC = b'\x89PMS'
+BINARY_VERSION = 1
+BINARY_HEADER_FMT = '>4sBI'
+# level 1 is ~2x faster than the default at shutdown for a few % larger records
+BINARY_COMPRESSLEVEL = 1
+# Set PYMODULE_LOG_SPOOL to a node-local directory (e.g. /dev/shm/pymodulesnooper,
+# created by root with mode 1777) to append binary records to
+# SPOOL/year/month/day/hostname.uid.spool instead of creating one file per process on
+# LOGFILE_ROOT; flush_spool.py moves them to the shared tree
+SPOOL_ROOT = os.environ.get('PYMODULE_LOG_SPOOL', '')
+SPOOL_RETRIES = 3
+# The write to the log tree gets WRITE_TIMEOUT seconds; a record that is not
+# written by then (slow or hung filesystem) or whose write fails goes to the
+# node-local FALLBACK_SPOOL_ROOT instead, for flush_spool.py to pick up. Without
+# SPOOL_ROOT it is a private (0700) directory per user, as one shared /tmp
+# directory would be created by whichever user came first
+WRITE_TIMEOUT = env_number('PYMODULE_LOG_WRITE_TIMEOUT', 2.0, float)
+FALLBACK_SPOOL_ROOT = SPOOL_ROOT or os.path.join('/tmp', 'pymodulesnooper-spool-{}'.format(os.getuid()))
+# how each record left the process (collector, spool, file, timeout, error; lost
+# if the fallback spool failed too) is
+# counted in this file of CACHE_DIR
+WRITE_PATHS_FILE = 'write_paths.json'
+# When the per-node collector.py daemon listens on this Unix socket, the record is
+# handed to it with one non-blocking sendto(); otherwise it is written as above
+COLLECTOR_SOCKET = os.environ.get(
+    'PYMODULE_LOG_SOCKET', os.path.join('/run', 'pymodulesnooper', 'collector.sock')
+)
+# Node-local, per-user cache directory. Versions come from installed distribution
+# metadata instead of module __version__ attributes, which can trigger lazy imports
+# at shutdown; each site-packages directory's {top-level module: [distribution,
+# version]} index is cached here and rebuilt when the directory's mtime changes.
+# It is only used if it is a directory of this user with mode 0700 (see private_dir)
+CACHE_DIR = os.environ.get(
+    'PYMODULE_LOG_CACHE', os.path.join('/tmp', 'pymodulesnooper-{}'.format(os.getuid()))
+)
+# Records with the same executable, modules, versions and job id as one already
+# written today are reduced to a reference (timestamp, pid, argv, env, sys.path, mpi)
+# to the blob holding their shared fields. The last FINGERPRINT_CACHE_SIZE
+# fingerprints written from this node, with the hash of that blob, are kept in
+# CACHE_DIR (LRU); 0 disables this
+FINGERPRINT_CACHE_SIZE = env_number('PYMODULE_LOG_FINGERPRINTS', 256)
+FINGERPRINT_CACHE = 'fingerprints.json'
+RECORD_BLOB = 'record'
+SHARED_FIELDS = (
+    'sys.executable', 'path_prefixes', 'modules', 'versions', 'distributions', 'blobs',
+)
+# env (ranks, node ids), sys.path (not part of the fingerprint) and mpi differ
+# between processes of the same fingerprint; they stay in each record, also as the
+# hash of a blob
+REFERENCE_FIELDS = (
+    'timestamp', 'sys.argv', 'hostname', 'pid', 'parent_pid', 'env', 'sys.path', 'mpi',
+    'snapshot', 'resources', 'import_times',
+)
+# Set PYMODULE_LOG_IMPORT_TIMES=1 to install ImportTimer at startup and log, for up
+# to IMPORT_TIMES_CAPACITY modules imported after it, the time to find and to
+# execute each one and the module that imported it
+IMPORT_TIMES = os.environ.get('PYMODULE_LOG_IMPORT_TIMES', '')
+IMPORT_TIMES_CAPACITY = 8192
+# Set PYMODULE_LOG_MPI=reduce to log the module sets of every MPI rank instead of
+# rank 0's only: ranks merge their distinct module sets up a binomial tree over
+# COMM_WORLD and rank 0 writes one record. A rank that has not reported within
+# MPI_REDUCE_TIMEOUT seconds (e.g. it called os._exit) is left out
+MPI_MODE = os.environ.get('PYMODULE_LOG_MPI', 'rank0')
+MPI_REDUCE_TAG = 0x504d
+MPI_REDUCE_TIMEOUT = 10.0
+MPI_POLL_INTERVAL = 0.001
+# Set PYMODULE_LOG_SNAPSHOTS to a number of seconds to also log from a daemon thread
+# while the process runs, so jobs killed before atexit (walltime SIGTERM/SIGKILL) leave
+# a record: a full record after that many seconds, then deltas with the modules loaded
+# since, at intervals doubling up to SNAPSHOT_MAX_INTERVAL. The record written at exit
+# closes the series
+SNAPSHOT_INTERVAL = env_number('PYMODULE_LOG_SNAPSHOTS', 0.0, float)
+SNAPSHOT_MAX_INTERVAL = 3600.0
+# Child interpreters find the pid of their closest logging ancestor in PARENT_MARKER.
+# Forked children log only the modules loaded after the fork. Spawned children
+# (multiprocessing spawn workers, python subprocesses) log their record whole and,
+# when it went to a file of its own, leave a note in CACHE_DIR/children named after
+# the parent's pid and start time; the parent, at exit, cuts the record down to the
+# modules it did not load itself, removing it if none are left, if the child ran the
+# same interpreter. Child records carry 'parent_pid'
+PARENT_MARKER = 'PYMODULE_LOG_PARENT'
+CHILDREN_DIRNAME = 'children'
+# Site detection reads PBS_CONF once and caches the answer for child processes
+PBS_CONF = '/etc/pbs.conf'
+SITE_MARKER = 'PYMODULE_LOG_ON_SIRIUS'
 
 
 def date_fmt(n):
     return "%02d" % n
 
 
+def encode_binary_record(info):
+    import json
+    import struct
+    import zlib
+    payload = zlib.compress(json.dumps(info).encode(), BINARY_COMPRESSLEVEL)
+    return struct.pack(BINARY_HEADER_FMT, BINARY_MAGIC, BINARY_VERSION, len(payload)) + payload
+
+
+def private_dir(path):
+    '''Create path (mode 0700) if missing and return it; raise PermissionError
+    unless it is a directory, not a symlink, owned by this user and closed to
+    others, as one another user created first could hold planted files'''
+    import stat
+    try:
+        os.makedirs(path, mode=0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) != 0o700:
+        raise PermissionError('not a private directory: {}'.format(path))
+    return path
+
+
+def open_owned(path, flags, mode=0o600):
+    '''os.open(path, flags) that does not follow a symlink, and raises
+    PermissionError unless it opened a regular file of this user with no other
+    links: a name planted in a shared directory cannot redirect the write'''
+    import stat
+    fd = os.open(path, flags | os.O_NOFOLLOW | os.O_CLOEXEC, mode)
+    st = os.fstat(fd)
+    if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() or st.st_nlink != 1:
+        os.close(fd)
+        raise PermissionError('not a file of this user: {}'.format(path))
+    return fd
+
+
+def makedirs_shared(path, top, mode=0o3777):
+    '''Create path and its missing parents below top writable by every user, as
+    create_dirs.py does; top itself is never created (OSError if missing), so
+    the year and month of the log tree keep the owner and mode create_dirs.py
+    gave them'''
+    if path == top or os.path.isdir(path):
+        return
+    makedirs_shared(os.path.dirname(path), top, mode)
+    try:
+        os.mkdir(path)
+        os.chmod(path, mode)
+    except FileExistsError:
+        pass
+
+
+def append_to_spool(spool_path, data):
+    '''Append data to spool_path with one write under a shared lock.
+
+    The flusher renames the spool file and then takes an exclusive lock on it,
+    so a writer that raced with the rename sees a different inode at
+    spool_path and retries with the new file.
+    '''
+    import fcntl
+    for _ in range(SPOOL_RETRIES):
+        fd = open_owned(spool_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            try:
+                current = os.stat(spool_path).st_ino
+            except FileNotFoundError:
+                continue
+            if os.fstat(fd).st_ino == current:
+                os.write(fd, data)
+                return True
+        finally:
+            os.close(fd)
+    return False
+
+
+def send_to_collector(data):
+    '''True if the collector daemon accepted data, False if it should be written here'''
+    if not COLLECTOR_SOCKET or not os.path.exists(COLLECTOR_SOCKET):
+        return False
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.setblocking(False)
+        sock.sendto(data, COLLECTOR_SOCKET)
+        return True
+    except OSError:
+        # not listening, buffer full (EAGAIN) or record too large (EMSGSIZE)
+        return False
+    finally:
+        sock.close()
+
+
+def load_fingerprints(blob_dir):
+    '''{fingerprint: hash of its shared blob} stored in blob_dir from this node,
+    least recently written first'''
+    import json
+    try:
+        private_dir(CACHE_DIR)
+        with os.fdopen(open_owned(os.path.join(CACHE_DIR, FINGERPRINT_CACHE), os.O_RDONLY)) as f:
+            cached = json.load(f)
+        if cached['blob_dir'] == blob_dir and isinstance(cached['fingerprints'], dict):
+            return cached['fingerprints']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    # a new day (or log root) starts an empty cache
+    return {}
+
+
+def save_fingerprints(blob_dir, fingerprints):
+    import json
+    cache_path = os.path.join(CACHE_DIR, FINGERPRINT_CACHE)
+    try:
+        private_dir(CACHE_DIR)
+        tmp_path = '{}.{}'.format(cache_path, os.getpid())
+        with os.fdopen(open_owned(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC), 'w') as f:
+            recent = dict(list(fingerprints.items())[-FINGERPRINT_CACHE_SIZE:])
+            json.dump({'blob_dir': blob_dir, 'fingerprints': recent}, f)
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        pass
+
+
+def resource_summary():
+    '''Wall time since startup, CPU times, peak RSS and thread count of this process'''
+    times = os.times()
+    summary = {
+        'wall_s': round(times.elapsed - START_TIMES.elapsed, 3),
+        'user_s': times.user,
+        'sys_s': times.system,
+    }
+    try:
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        # finer than the clock ticks of os.times()
+        summary['user_s'], summary['sys_s'] = usage.ru_utime, usage.ru_stime
+        # kilobytes on Linux
+        summary['maxrss_kb'] = usage.ru_maxrss
+    except ImportError:
+        pass
+    try:
+        # native threads too (OpenMP, BLAS, CUDA)
+        summary['threads'] = len(os.listdir('/proc/self/task'))
+    except OSError:
+        import threading
+        summary['threads'] = threading.active_count()
+    return summary
+
+
+def shard_name(hostname):
+    import zlib
+    return '{}{:02x}'.format(SHARD_PREFIX, zlib.crc32(hostname.encode()) % SHARDS)
+
+
+def capture_env(environ):
+    '''Copy of environ filtered and truncated as configured in ENV_FILTER_FILE'''
+    import json
+    try:
+        with open(ENV_FILTER_FILE) as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        return environ.copy()
+    import fnmatch
+    import re
+
+    def compile_globs(globs):
+        return re.compile('|'.join(map(fnmatch.translate, globs))) if globs else None
+
+    allow = compile_globs(config.get('allow'))
+    deny = compile_globs(config.get('deny'))
+    max_length = config.get('max_value_length')
+    return {
+        name: value[:max_length]
+        for name, value in environ.items()
+        if (allow is None or allow.match(name)) and not (deny is not None and deny.match(name))
+    }
+
+
 class DictLogger:
     '''Set up logger to emit message to system log facility'''
-    def __init__(self):
+    def __init__(self, info=None, log_path=None, delta=False):
+        from datetime import datetime
+        import socket
         now = datetime.now()
-        self._info = {
-            'timestamp' : now.strftime(DATETIME_FMT),
-            'sys.executable': sys.executable,
-            'sys.argv': sys.argv,
-            'sys.path': sys.path,
-            'env': os.environ.copy(),
-            'hostname': socket.gethostname(),
-            'pid': os.getpid(),
-        }
-
-        logger = logging.getLogger("PyModuleSnooper")
-        logger.propagate = False
-        logger.setLevel(logging.INFO)
+        self._delta = delta
+        if delta:
+            # the process was described by an earlier record of the series
+            self._info = {
+                'timestamp' : now.strftime(DATETIME_FMT),
+                'hostname': socket.gethostname(),
+                'pid': os.getpid(),
+            }
+        else:
+            self._info = {
+                'timestamp' : now.strftime(DATETIME_FMT),
+                'sys.executable': sys.executable,
+                'sys.argv': sys.argv,
+                'sys.path': sys.path,
+                'env': capture_env(os.environ),
+                'hostname': socket.gethostname(),
+                'pid': os.getpid(),
+            }
+        if info is not None:
+            # the record of another process (a child's), logged by this one
+            self._info.update(info)
 
-        # LOGROOT/year/month/day/hostname.PID.hour.minute.second.m
+        # LOGROOT/year/month/day/[hXX/]hostname.PID.hour.minute.second.m
+        # or SPOOL/year/month/day/hostname.UID.spool in spool mode
         year, month, day = map(date_fmt, (now.year, now.month, now.day))
         # job_id = os.environ.get('PBS_JOBID', 'no-ID')
-        log_dir = os.path.join(LOGFILE_ROOT, year, month, day)
+        log_dir = os.path.join(SPOOL_ROOT or LOGFILE_ROOT, year, month, day)
+        self._blob_dir = os.path.join(log_dir, BLOB_DIRNAME)
+        # only the day (and its shard and blob store) is created on first use
+        self._top_dir = SPOOL_ROOT or os.path.join(LOGFILE_ROOT, year, month)
 
-        fname = '{}.{}.{}'.format(
-            socket.gethostname(), os.getpid(), now.strftime('%H.%M.%S.%f')
+        if SPOOL_ROOT:
+            fname = '{}.{}.spool'.format(socket.gethostname(), os.getuid())
+        else:
+            fname = '{}.{}.{}'.format(
+                socket.gethostname(), os.getpid(), now.strftime('%H.%M.%S.%f')
+            )
+            if SHARDS > 0:
+                log_dir = os.path.join(log_dir, shard_name(socket.gethostname()))
+        if log_path is not None and not SPOOL_ROOT:
+            # append to (or replace) the file of an earlier record, maybe of the day before
+            log_dir = os.path.dirname(log_path)
+            fname = os.path.basename(log_path)
+            log_day = os.path.relpath(log_dir, LOGFILE_ROOT).split(os.sep)[:3]
+            self._blob_dir = os.path.join(LOGFILE_ROOT, *log_day, BLOB_DIRNAME)
+            self._top_dir = os.path.join(LOGFILE_ROOT, *log_day[:2])
+        self._log_path = os.path.join(log_dir, fname)
+        self._fallback_path = os.path.join(
+            FALLBACK_SPOOL_ROOT, year, month, day,
+            '{}.{}.spool'.format(socket.gethostname(), os.getuid()),
         )
-        log_path = os.path.join(log_dir, fname)
-        handler_file = logging.FileHandler(log_path)
-        formatter = logging.Formatter('%(message)s')
-        handler_file.formatter = formatter
-        logger.addHandler(handler_file)
-        self._logger = logger
-
-    def log_modules(self, module_paths, module_versions):
-        self._info['modules'] = module_paths
+
+    @property
+    def log_path(self):
+        return self._log_path
+
+    def _store_blob(self, value):
+        '''Write value to the blob store once; return its hash, or None on failure'''
+        import hashlib
+        import json
+        blob = json.dumps(value, sort_keys=True).encode()
+        digest = hashlib.sha1(blob).hexdigest()
+        blob_path = os.path.join(self._blob_dir, digest)
+        if os.path.exists(blob_path):
+            return digest
+        try:
+            makedirs_shared(self._blob_dir, self._top_dir)
+            # write under a private name, then rename so readers never see partial blobs
+            tmp_path = os.path.join(self._blob_dir, '.{}.{}'.format(digest, os.getpid()))
+            # a new file: a name planted in the shared directory fails instead of being followed
+            with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o644), 'wb') as f:
+                f.write(blob)
+            os.rename(tmp_path, blob_path)
+        except OSError:
+            # another process may have won the race; otherwise keep the field inline
+            if not os.path.exists(blob_path):
+                return None
+        return digest
+
+    def _dedup_blobs(self):
+        blobs = {}
+        for field in BLOB_FIELDS:
+            if field not in self._info:
+                continue
+            digest = self._store_blob(self._info[field])
+            if digest is not None:
+                blobs[field] = digest
+                del self._info[field]
+        if blobs:
+            self._info['blobs'] = blobs
+
+    def _fingerprint(self):
+        import hashlib
+        import json
+        job_id = os.environ.get('PBS_JOBID', os.environ.get('COBALT_JOBID', ''))
+        key = [
+            self._info['sys.executable'], self._info['path_prefixes'], self._info['modules'],
+            self._info['versions'], job_id,
+        ]
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def _dedup_record(self):
+        '''Reduce the record to a reference if its fingerprint was written today'''
+        fingerprint = self._fingerprint()
+        written = load_fingerprints(self._blob_dir)
+        # the shared blob is named by its content, like any blob, so a reader can
+        # tell a blob planted under its name; the fingerprint is only a cache key
+        record_digest = written.pop(fingerprint, None)
+        blobs = self._info.get('blobs', {})
+        own_blobs = {field: digest for field, digest in blobs.items() if field in REFERENCE_FIELDS}
+        # the blob check guards against a cache that outlived the log tree
+        if record_digest is not None and os.path.exists(os.path.join(self._blob_dir, record_digest)):
+            self._info = {field: self._info[field] for field in REFERENCE_FIELDS if field in self._info}
+            own_blobs[RECORD_BLOB] = record_digest
+            self._info['blobs'] = own_blobs
+        else:
+            shared = {field: self._info[field] for field in SHARED_FIELDS if field in self._info}
+            if blobs:
+                shared['blobs'] = {field: digest for field, digest in blobs.items() if field not in own_blobs}
+            record_digest = self._store_blob(shared)
+            if record_digest is None:
+                return
+            self._info['fingerprint'] = record_digest
+        written[fingerprint] = record_digest
+        save_fingerprints(self._blob_dir, written)
+
+    def log_modules(self, module_paths, module_versions, module_distributions, mpi_info=None,
+                    import_times=None):
+        '''Write the record; returns how it left the process (see count_write_path)'''
+        self._info['path_prefixes'], self._info['modules'] = compress_module_paths(module_paths)
         self._info['versions'] = module_versions
-        self._logger.info(json.dumps(self._info))
+        self._info['distributions'] = module_distributions
+        if mpi_info is not None:
+            self._info['mpi'] = mpi_info
+        if import_times is not None:
+            self._info['import_times'] = import_times
+        # snapshot the record: _write() replaces fields while it runs
+        record = dict(self._info)
+        status, path = run_with_timeout(self._write, WRITE_TIMEOUT)
+        if status != 'done':
+            path = status
+            try:
+                if not SPOOL_ROOT:
+                    private_dir(FALLBACK_SPOOL_ROOT)
+                makedirs_shared(os.path.dirname(self._fallback_path), FALLBACK_SPOOL_ROOT)
+                if not append_to_spool(self._fallback_path, encode_binary_record(record)):
+                    path = 'lost'
+            except OSError:
+                path = 'lost'
+        count_write_path(path)
+        return path
 
+    def defer_to_parent(self, parent_key, module_paths, module_versions, module_distributions,
+                        mpi_info=None, import_times=None):
+        '''Log the record whole and, if it went to a file of its own, leave a
+        note in CACHE_DIR for the parent (parent_key from process_key) to cut it
+        down to the modules the parent did not load.
 
-def is_mpi_rank_nonzero():
-    '''False if not using mpi4py, or MPI has been finalized, or MPI has
-    not been initialized, or rank is 0. Otherwise, returns True if rank > 0.'''
+        As the record is in the log tree from the start, it stays whole, not
+        lost, if the parent is killed or has already looked for its children.
+        '''
+        import json
+        # the fields the parent needs to rewrite the record, before _write() replaces them
+        record = dict(self._info, versions=module_versions, distributions=module_distributions)
+        if self.log_modules(module_paths, module_versions, module_distributions, mpi_info,
+                            import_times) != 'file':
+            # a record sent to the collector or appended to a spool cannot be cut down
+            return
+        children_dir = os.path.join(CACHE_DIR, CHILDREN_DIRNAME)
+        path = os.path.join(children_dir, '{}.{}.json'.format(parent_key, os.getpid()))
+        note = {'path': self._log_path, 'record': record, 'modules': module_paths}
+        try:
+            private_dir(CACHE_DIR)
+            private_dir(children_dir)
+            tmp_path = os.path.join(children_dir, '.{}.json'.format(os.getpid()))
+            with os.fdopen(open_owned(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC), 'w') as f:
+                json.dump(note, f)
+            os.rename(tmp_path, path)
+        except OSError:
+            pass
+
+    def replace_log(self):
+        '''Replace the file at log_path (a child's, written by _write()) with the record'''
+        self._dedup_blobs()
+        # readers skip dot files, and never see the record half written
+        tmp_path = os.path.join(
+            os.path.dirname(self._log_path), '.{}.{}'.format(os.path.basename(self._log_path), os.getpid())
+        )
+        with os.fdopen(open_owned(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644), 'wb') as f:
+            f.write(self._encode())
+        os.rename(tmp_path, self._log_path)
+
+    def _encode(self):
+        if RECORD_FORMAT == 'binary':
+            return encode_binary_record(self._info)
+        import json
+        return (json.dumps(self._info) + '\n').encode()
+
+    def _write(self):
+        '''Write the record; returns how it left the process'''
+        if send_to_collector(encode_binary_record(self._info)):
+            return 'collector'
+        self._dedup_blobs()
+        if FINGERPRINT_CACHE_SIZE > 0 and not self._delta:
+            self._dedup_record()
+        if SPOOL_ROOT:
+            makedirs_shared(os.path.dirname(self._log_path), self._top_dir)
+            append_to_spool(self._log_path, encode_binary_record(self._info))
+            return 'spool'
+        # the day (or its shard) may not have been created by create_dirs.py
+        makedirs_shared(os.path.dirname(self._log_path), self._top_dir)
+        data = self._encode()
+        # written directly, not through a logging handler: DictLoggers of other
+        # threads (snapshots, children, an abandoned write) each have their own file
+        with os.fdopen(open_owned(self._log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644), 'ab') as f:
+            f.write(data)
+        return 'file'
+
+
+class WriteTimeout(Exception):
+    pass
+
+
+def run_with_timeout(func, timeout):
+    '''Run func within timeout seconds: returns ('done', result), ('timeout', None)
+    or ('error', None).
+
+    func runs in a daemon thread that is abandoned if it overruns, so a hung
+    filesystem does not hold up the interpreter's exit. Python 3.12+ refuses
+    to start threads at exit; there a SIGALRM timer interrupts func instead.
+    '''
+    import threading
+    result = []
+
+    def target():
+        try:
+            result.append(('done', func()))
+        except Exception:
+            result.append(('error', None))
+
+    writer = threading.Thread(target=target, daemon=True)
+    try:
+        writer.start()
+    except RuntimeError:
+        return run_with_alarm(func, timeout)
+    writer.join(timeout)
+    if result:
+        return result[0]
+    return ('timeout', None)
+
+
+def run_with_alarm(func, timeout):
+    '''run_with_timeout using ITIMER_REAL; the caller's handler and timer are restored.
+
+    The signal only interrupts func between system calls or in an
+    interruptible one: a write stuck in uninterruptible sleep (D state, as on a
+    hung Lustre mount) holds up the exit until the kernel returns from it.
+    '''
+    import signal
+    import threading
+    if threading.current_thread() is not threading.main_thread():
+        # signals are only delivered to the main thread: no time limit
+        try:
+            return ('done', func())
+        except Exception:
+            return ('error', None)
+
+    def on_alarm(signum, frame):
+        raise WriteTimeout()
+
+    previous_handler = signal.signal(signal.SIGALRM, on_alarm)
+    previous_timer = signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return ('done', func())
+    except WriteTimeout:
+        return ('timeout', None)
+    except Exception:
+        return ('error', None)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+        if previous_timer[0] > 0:
+            signal.setitimer(signal.ITIMER_REAL, *previous_timer)
+
+
+def count_write_path(path):
+    '''Increment the node-local counter of records that left the process by path'''
+    import fcntl
+    import json
+    try:
+        private_dir(CACHE_DIR)
+        with os.fdopen(open_owned(os.path.join(CACHE_DIR, WRITE_PATHS_FILE), os.O_RDWR | os.O_CREAT), 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                counts = json.load(f)
+            except ValueError:
+                counts = {}
+            counts[path] = counts.get(path, 0) + 1
+            f.seek(0)
+            f.truncate()
+            json.dump(counts, f)
+    except OSError:
+        pass
+
+
+def get_mpi_comm():
+    '''COMM_WORLD if mpi4py is loaded and MPI is initialized and not finalized,
+    otherwise None.'''
     MPI = None
     if 'mpi4py' in sys.modules:
         if hasattr(sys.modules['mpi4py'], 'MPI'):
             MPI = sys.modules['mpi4py'].MPI
 
     if MPI is None:
-        return False
+        return None
     elif hasattr(MPI, "Is_finalized") and MPI.Is_finalized():
-        return False
+        return None
     elif hasattr(MPI, "Is_initialized") and not MPI.Is_initialized():
-        return False
-    elif hasattr(MPI, "COMM_WORLD"):
-        return MPI.COMM_WORLD.Get_rank() > 0
+        return None
     else:
+        return getattr(MPI, "COMM_WORLD", None)
+
+
+def is_mpi_rank_nonzero():
+    '''False if not using mpi4py, or MPI has been finalized, or MPI has
+    not been initialized, or rank is 0. Otherwise, returns True if rank > 0.'''
+    comm = get_mpi_comm()
+    return comm is not None and comm.Get_rank() > 0
+
+
+def module_set_digest(module_paths):
+    import hashlib
+    return hashlib.sha1('\n'.join(sorted(module_paths)).encode()).hexdigest()
+
+
+def reduce_module_sets(comm, module_paths, timeout=MPI_REDUCE_TIMEOUT):
+    '''Gather the distinct module sets of all ranks of comm on rank 0.
+
+    comm may be any object with the mpi4py communicator methods used here
+    (Get_rank, Get_size, isend, iprobe, recv), e.g. an in-process fake for
+    testing. Sets are merged as {digest: [rank count, module_paths]} at every
+    level of a binomial tree, so only distinct sets travel. Returns the merged
+    sets on rank 0 and None on other ranks.
+    '''
+    import time
+    rank, size = comm.Get_rank(), comm.Get_size()
+    sets = {module_set_digest(module_paths): [1, module_paths]}
+    deadline = time.monotonic() + timeout
+    step = 1
+    while step < size:
+        if rank % (2 * step):
+            request = comm.isend(sets, dest=rank - step, tag=MPI_REDUCE_TAG)
+            while not request.Test() and time.monotonic() < deadline:
+                time.sleep(MPI_POLL_INTERVAL)
+            return None
+        child = rank + step
+        if child < size:
+            # poll rather than block, so a rank that never reports cannot hang exit
+            while not comm.iprobe(source=child, tag=MPI_REDUCE_TAG):
+                if time.monotonic() > deadline:
+                    break
+                time.sleep(MPI_POLL_INTERVAL)
+            else:
+                for digest, (count, paths) in comm.recv(source=child, tag=MPI_REDUCE_TAG).items():
+                    if digest in sets:
+                        sets[digest][0] += count
+                    else:
+                        sets[digest] = [count, paths]
+        step *= 2
+    return sets
+
+
+def merge_module_sets(sets, size):
+    '''Union of the gathered module paths and the per-set summary for the record'''
+    module_paths = {}
+    for count, paths in sets.values():
+        for name, path in paths.items():
+            module_paths.setdefault(name, path)
+    module_sets = [
+        {'ranks': count, 'missing': sorted(set(module_paths) - set(paths))}
+        for count, paths in sorted(sets.values(), key=lambda item: -item[0])
+    ]
+    return module_paths, {'size': size, 'module_sets': module_sets}
+
+
+def dist_top_levels(dist):
+    '''Top-level module names provided by an importlib.metadata distribution'''
+    text = dist.read_text('top_level.txt')
+    if text:
+        return text.split()
+    names = set()
+    for file in dist.files or ():
+        top = file.parts[0]
+        if len(file.parts) == 1:
+            # single-file modules: foo.py, foo.cpython-311-x86_64-linux-gnu.so
+            if not top.endswith(('.py', '.so', '.pyd')):
+                continue
+            top = top.split('.')[0]
+        if top.isidentifier() and top != '__pycache__':
+            names.add(top)
+    return sorted(names)
+
+
+def build_dist_index(path):
+    '''{top-level module: [distribution, version]} for distributions installed in path'''
+    try:
+        from importlib import metadata
+    except ImportError:
+        return {}
+    index = {}
+    for dist in metadata.distributions(path=[path]):
+        try:
+            entry = [dist.metadata['Name'], dist.version]
+            tops = dist_top_levels(dist)
+        except Exception:
+            # a malformed distribution (e.g. a bad RECORD row) must not cost the record
+            continue
+        for top in tops:
+            index.setdefault(top, entry)
+    return index
+
+
+def load_dist_index(path):
+    '''build_dist_index(path), cached in CACHE_DIR until path's mtime changes'''
+    import hashlib
+    import json
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return {}
+    cache_path = os.path.join(CACHE_DIR, hashlib.sha1(path.encode()).hexdigest())
+    try:
+        private_dir(CACHE_DIR)
+        with os.fdopen(open_owned(cache_path, os.O_RDONLY)) as f:
+            cached = json.load(f)
+        if cached['path'] == path and cached['mtime'] == mtime:
+            return cached['index']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    index = build_dist_index(path)
+    try:
+        private_dir(CACHE_DIR)
+        tmp_path = '{}.{}'.format(cache_path, os.getpid())
+        with os.fdopen(open_owned(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC), 'w') as f:
+            json.dump({'path': path, 'mtime': mtime, 'index': index}, f)
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        pass
+    return index
+
+
+def path_prefixes():
+    '''sys.path directories and the interpreter prefixes, deepest first, each ending in a separator'''
+    entries = [os.path.abspath(entry or os.curdir) for entry in sys.path]
+    entries += [sys.prefix, sys.exec_prefix]
+    return sorted({os.path.join(entry, '') for entry in entries}, key=len, reverse=True)
+
+
+def compress_module_paths(module_paths):
+    '''Encode module paths against a table of the path prefixes they share.
+
+    Returns (prefixes, modules) where each module path under one of
+    path_prefixes() becomes [index into prefixes, path relative to it]; other
+    paths (and None) are kept as they are.
+    '''
+    entries = path_prefixes()
+    prefixes, indices, modules = [], {}, {}
+    for name, path in module_paths.items():
+        modules[name] = path
+        if not path:
+            continue
+        for entry in entries:
+            if path.startswith(entry):
+                if entry not in indices:
+                    indices[entry] = len(prefixes)
+                    prefixes.append(entry)
+                modules[name] = [indices[entry], path[len(entry):]]
+                break
+    return prefixes, modules
+
+
+def resolve_versions(module_paths):
+    '''Versions and distributions of the loaded top-level modules that come from one.
+
+    Only the sys.path directories that loaded modules live in are indexed; a
+    module belongs to the deepest one containing it (site-packages rather
+    than the stdlib directory above it). Namespace packages (such as
+    'google') have no file; they belong to the directories of their portions,
+    in __path__, and take the version of the first one found in an index.
+    The script's directory and the working directory are not indexed: jobs
+    write their output there, so their mtime, and with it the cached index,
+    would change at every run.
+    '''
+    entries = path_prefixes()
+    volatile = {os.path.join(os.path.abspath(entry), '') for entry in (sys.path[:1] + [os.curdir])}
+    by_entry = {}
+    for name, path in module_paths.items():
+        if '.' in name:
+            continue
+        if path:
+            locations = [path]
+        else:
+            module = sys.modules.get(name)
+            try:
+                locations = list(getattr(module, '__path__', None) or [])
+            except TypeError:
+                locations = []
+        for location in locations:
+            for entry in entries:
+                if location.startswith(entry):
+                    by_entry.setdefault(entry, []).append(name)
+                    break
+
+    versions, distributions = {}, {}
+    for entry, names in by_entry.items():
+        if entry in volatile:
+            continue
+        index = load_dist_index(os.path.dirname(entry))
+        for name in names:
+            if name in index and name not in versions:
+                distributions[name], versions[name] = index[name]
+    return versions, distributions
+
+
+class ImportTimer:
+    '''sys.meta_path finder timing the imports that follow its installation.
+
+    find_spec() asks the other finders for the spec itself, timing the
+    search, and wraps the loader's exec_module() to time execution, which
+    includes the imports the module triggers (its import subtree). The module
+    executing when an import starts is recorded as its importer. Results go
+    to arrays preallocated for IMPORT_TIMES_CAPACITY modules; later imports
+    are only counted. Attribution is approximate when threads import
+    concurrently.
+    '''
+    def __init__(self, capacity=IMPORT_TIMES_CAPACITY):
+        from array import array
+        from time import perf_counter_ns
+        self._clock = perf_counter_ns
+        self._capacity = capacity
+        self._names = []
+        self._index = {}
+        self._importers = array('i', bytes(4 * capacity))
+        self._find_ns = array('q', bytes(8 * capacity))
+        self._exec_ns = array('q', bytes(8 * capacity))
+        self._stack = []
+        self._dropped = 0
+
+    def find_spec(self, name, path=None, target=None):
+        if len(self._names) >= self._capacity:
+            self._dropped += 1
+            return None
+        start = self._clock()
+        for finder in sys.meta_path:
+            find_spec = getattr(finder, 'find_spec', None)
+            if finder is self or find_spec is None:
+                continue
+            spec = find_spec(name, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+
+        index = len(self._names)
+        self._names.append(name)
+        self._index[name] = index
+        self._importers[index] = self._stack[-1] if self._stack else -1
+        self._find_ns[index] = self._clock() - start
+        loader = spec.loader
+        # loader classes (builtin, frozen) are shared by every module: leave them alone
+        if loader is not None and not isinstance(loader, type) and hasattr(loader, '__dict__'):
+            if 'exec_module' not in vars(loader) and hasattr(loader, 'exec_module'):
+                loader.exec_module = self._timed(loader.exec_module)
+        return spec
+
+    def _timed(self, exec_module):
+        def exec_module_timed(module):
+            index = self._index.get(module.__name__)
+            if index is None:
+                return exec_module(module)
+            self._stack.append(index)
+            start = self._clock()
+            try:
+                return exec_module(module)
+            finally:
+                self._exec_ns[index] = self._clock() - start
+                self._stack.pop()
+        return exec_module_timed
+
+    def stop(self):
+        '''Stop timing: the hook's own imports at exit are not the program's'''
+        try:
+            sys.meta_path.remove(self)
+        except ValueError:
+            pass
+
+    def summary(self):
+        '''Columns for the record, all of the same length; importers index into
+        modules, -1 for none'''
+        count = len(self._names)
+        return {
+            'modules': self._names[:count],
+            'importers': self._importers[:count].tolist(),
+            'find_us': [ns // 1000 for ns in self._find_ns[:count]],
+            'exec_us': [ns // 1000 for ns in self._exec_ns[:count]],
+            'dropped': self._dropped,
+        }
+
+
+import_timer = None
+
+
+class SnapshotSeries:
+    '''Log the modules of a running process from a daemon thread.
+
+    The first snapshot is a full record; later ones, and the one written at
+    exit, are deltas with the modules loaded since, appended to the same log
+    file. All carry 'snapshot': {'series': time of the first, 'seq': n,
+    'final': bool}, which snooper_records.merge_snapshots uses to merge them.
+
+    Modules first loaded while a snapshot is written are the hook's own
+    (json, socket, importlib.metadata, ...) and are left out of the deltas.
+    '''
+    def __init__(self, interval):
+        import threading
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='PyModuleSnooper', daemon=True)
+        self._series = None
+        self._seq = 0
+        self._logged = set()
+        self._hook_modules = set()
+        self._log_path = None
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        import time
+        interval = self._interval
+        while True:
+            time.sleep(interval)
+            interval = min(2 * interval, SNAPSHOT_MAX_INTERVAL)
+            if is_mpi_rank_nonzero():
+                return
+            self.snapshot(loaded_module_paths())
+
+    def snapshot(self, module_paths, final=False, mpi_info=None, import_times=None):
+        '''Log the modules not logged yet; returns False if no series was started'''
+        # a snapshot stuck writing must not hold up the final record
+        if not self._lock.acquire(timeout=WRITE_TIMEOUT):
+            return False
+        before = set(sys.modules)
+        try:
+            if final and self._series is None:
+                return False
+            new_paths = {
+                module: path for module, path in module_paths.items()
+                if module not in self._logged and module not in self._hook_modules
+            }
+            if not new_paths and not final:
+                return True
+            if self._series is None:
+                from datetime import datetime
+                self._series = datetime.now().strftime(DATETIME_FMT)
+            info = {
+                'snapshot': {'series': self._series, 'seq': self._seq, 'final': final},
+                'resources': resource_summary(),
+            }
+            if self._log_path is None:
+                logger = DictLogger(info)
+                self._log_path = logger.log_path
+            else:
+                logger = DictLogger(info, self._log_path, delta=True)
+            module_versions, module_distributions = resolve_versions(new_paths)
+            logger.log_modules(new_paths, module_versions, module_distributions, mpi_info, import_times)
+            self._logged.update(new_paths)
+            self._seq += 1
+            return True
+        finally:
+            self._hook_modules.update(set(sys.modules) - before)
+            self._lock.release()
+
+
+snapshot_series = None
+# pid of the logging process that started this one, and for a forked child the
+# modules loaded at the time of the fork
+parent_pid = None
+fork_modules = None
+# pid of this logging process, kept here as the program may clear the environment
+logging_pid = None
+
+
+def on_fork():
+    global parent_pid, fork_modules, logging_pid, snapshot_series, START_TIMES
+    START_TIMES = os.times()
+    # the snapshot thread is not running in the child
+    snapshot_series = None
+    parent_pid = logging_pid
+    logging_pid = os.getpid()
+    fork_modules = set(sys.modules)
+    os.environ[PARENT_MARKER] = str(logging_pid)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
         return False
+    except OSError:
+        pass
+    return True
 
 
-def inspect_and_log():
-    '''Grab paths of all loaded modules and log them'''
-    if is_mpi_rank_nonzero():
+def process_start(pid):
+    '''Start time of process pid in clock ticks after boot, or 0 if unknown'''
+    try:
+        with open('/proc/{}/stat'.format(pid), 'rb') as f:
+            stat = f.read()
+        # after the command name, which may hold spaces and parentheses
+        return int(stat.rsplit(b')', 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def process_key(pid):
+    '''pid and start time of process pid, which tell it from a later one given the same pid'''
+    return '{}.{}'.format(pid, process_start(pid))
+
+
+def cut_down_child(note, loaded):
+    '''Replace the record a child logged whole with one without the modules in
+    loaded, or remove it if there are no others'''
+    path = note['path']
+    extra = {module: module_path for module, module_path in note['modules'].items() if module not in loaded}
+    if not extra:
+        os.unlink(path)
         return
-    if os.environ.get('DISABLE_PYMODULE_LOG', False):
+    top_levels = {module.split('.')[0] for module in extra}
+    record = dict(note['record'])
+    record['path_prefixes'], record['modules'] = compress_module_paths(extra)
+    for field in ('versions', 'distributions'):
+        record[field] = {top: value for top, value in record[field].items() if top in top_levels}
+    DictLogger(record, path).replace_log()
+
+
+def log_children(module_paths):
+    '''Cut the records children logged whole for this process down to the
+    modules not in module_paths; notes left for processes that are gone are
+    dropped, their children's records staying whole'''
+    import json
+    children_dir = os.path.join(CACHE_DIR, CHILDREN_DIRNAME)
+    try:
+        private_dir(CACHE_DIR)
+        if not os.path.lexists(children_dir):
+            return
+        names = os.listdir(private_dir(children_dir))
+    except OSError:
         return
+    own_key = process_key(os.getpid())
+    for name in names:
+        parts = name.split('.')
+        if name.startswith('.') or len(parts) != 4 or not all(part.isdigit() for part in parts[:3]):
+            continue
+        owner, owner_key = int(parts[0]), '.'.join(parts[:2])
+        if owner_key != own_key and process_alive(owner) and process_key(owner) == owner_key:
+            # its parent is still running
+            continue
+        # claim the note, so it is used once when processes sweep concurrently
+        claimed_path = os.path.join(children_dir, '.{}.{}'.format(name, os.getpid()))
+        try:
+            os.rename(os.path.join(children_dir, name), claimed_path)
+            with os.fdopen(open_owned(claimed_path, os.O_RDONLY)) as f:
+                note = json.load(f)
+            os.unlink(claimed_path)
+        except (OSError, ValueError):
+            continue
+        # modules of another interpreter are other files, even under the same names;
+        # and in spool mode this process could not replace the child's file
+        if owner_key == own_key and note['record'].get('sys.executable') == sys.executable and not SPOOL_ROOT:
+            run_with_timeout(lambda: cut_down_child(note, module_paths), WRITE_TIMEOUT)
 
-    logger = DictLogger()
-    module_paths = {
+
+def loaded_module_paths():
+    return {
         module_name: module.__file__
         for module_name, module in sys.modules.copy().items()
         if hasattr(module, '__file__')
     }
-    module_versions = {
-        module_name: str(getattr(module, "__version__", None))
-        for module_name, module in sys.modules.copy().items()
-        if module_name in module_paths
-    }
-    logger.log_modules(module_paths, module_versions)
+
+
+def inspect_and_log():
+    '''Grab paths of all loaded modules and log them'''
+    if os.environ.get('DISABLE_PYMODULE_LOG', False):
+        return
+    import_times = None
+    if import_timer is not None:
+        # before anything below imports the hook's own dependencies
+        import_timer.stop()
+        import_times = import_timer.summary()
+    comm = get_mpi_comm()
+    if comm is not None and MPI_MODE != 'reduce' and comm.Get_rank() > 0:
+        return
+
+    module_paths = loaded_module_paths()
+    log_children(module_paths)
+    info = {'resources': resource_summary()}
+    if parent_pid is not None:
+        info['parent_pid'] = parent_pid
+    if fork_modules is not None:
+        # the parent logs what was loaded before the fork
+        module_paths = {
+            module: path for module, path in module_paths.items() if module not in fork_modules
+        }
+        if not module_paths:
+            return
+
+    mpi_info = None
+    if comm is not None and MPI_MODE == 'reduce':
+        sets = reduce_module_sets(comm, module_paths)
+        if sets is None:
+            return
+        module_paths, mpi_info = merge_module_sets(sets, comm.Get_size())
+
+    if snapshot_series is not None:
+        if snapshot_series.snapshot(module_paths, True, mpi_info, import_times):
+            return
+
+    logger = DictLogger(info)
+    module_versions, module_distributions = resolve_versions(module_paths)
+    if fork_modules is None and parent_pid is not None and os.getppid() == parent_pid:
+        logger.defer_to_parent(
+            process_key(parent_pid), module_paths, module_versions, module_distributions, mpi_info,
+            import_times,
+        )
+        return
+    logger.log_modules(
+        module_paths, module_versions, module_distributions, mpi_info, import_times
+    )
+
+
+def on_sirius():
+    '''True on Sirius, where Eagle is not mounted.
+
+    The answer is cached in the environment, so child interpreters (conda's
+    subprocesses, workers, `python -c` helpers in scripts) skip reading pbs.conf.
+    '''
+    cached = os.environ.get(SITE_MARKER)
+    if cached is None:
+        try:
+            with open(PBS_CONF) as f:
+                cached = '1' if 'PBS_SERVER=sirius' in f.read() else '0'
+        except OSError:
+            cached = '0'
+        os.environ[SITE_MARKER] = cached
+    return cached == '1'
 
 
 if not os.environ.get('DISABLE_PYMODULE_LOG', False):
     # dont register the logger on Sirius since Eagle is not mounted
-    on_sirius = False
-    with open('/etc/pbs.conf', 'r') as f:
-        for line in f.readlines():
-            if re.search("PBS_SERVER=sirius", line):
-                on_sirius = True
-    if not on_sirius:
+    if not on_sirius():
         atexit.register(inspect_and_log)
+        if os.environ.get(PARENT_MARKER, '').isdigit():
+            parent_pid = int(os.environ[PARENT_MARKER])
+        logging_pid = os.getpid()
+        os.environ[PARENT_MARKER] = str(logging_pid)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=on_fork)
+        if SNAPSHOT_INTERVAL > 0:
+            snapshot_series = SnapshotSeries(SNAPSHOT_INTERVAL)
+            snapshot_series.start()
+        if IMPORT_TIMES:
+            import_timer = ImportTimer()
+            sys.meta_path.insert(0, import_timer)
     # [[ " $( qstat -B ) " =~ "polaris" ]] && echo "polaris!"